@@ -1,26 +1,12 @@
+import time
+import numpy as np
 import SimpleITK as sitk
 from functools import reduce
-from registration_tools import register_station
+from concurrent.futures import ThreadPoolExecutor
+from registration_tools import station_key, calculate_station_translation, move_station
 
 
 def reformat_to_axial(image_volume, print_results=True):
-    spacing = (image_volume.GetSpacing()[0], image_volume.GetSpacing()[2],
-               image_volume.GetSpacing()[1])
-    size = (image_volume.GetSize()[0], image_volume.GetSize()[2], image_volume.GetSize()[1])
-    direction = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
-
-    origin = (image_volume.GetOrigin()[0], image_volume.GetOrigin()[1],
-              image_volume.GetOrigin()[2] - image_volume.GetSpacing()[1] * image_volume.GetSize()[1])
-
-    resample = sitk.ResampleImageFilter()
-    resample.SetOutputSpacing(spacing)
-    resample.SetSize(size)
-    resample.SetOutputDirection(direction)
-    resample.SetOutputOrigin(origin)
-    resample.SetTransform(sitk.Transform())
-    resample.SetDefaultPixelValue(0)
-    resample.SetInterpolator(sitk.sitkLinear)
-
     # quick function for rounding tuples:
     round_tuple = lambda t, n=2: tuple(round(e, n) for e in t)
 
@@ -30,7 +16,13 @@ def reformat_to_axial(image_volume, print_results=True):
     old_spacing = round_tuple(image_volume.GetSpacing())
     old_size = image_volume.GetSize()
 
-    image_volume = resample.Execute(image_volume)
+    # orthogonal volumes are reformatted by reordering voxels, others need resampling
+    axial_volume = permute_to_axial(image_volume)
+    method = 'axis permutation'
+    if axial_volume is None:
+        axial_volume = resample_to_axial(image_volume)
+        method = 'linear resampling'
+    image_volume = axial_volume
 
     new_direction = image_volume.GetDirection()
     new_origin = round_tuple(image_volume.GetOrigin())
@@ -38,6 +30,7 @@ def reformat_to_axial(image_volume, print_results=True):
     new_size = image_volume.GetSize()
 
     if print_results:
+        print('Method:', method)
         print('Direction:', old_direction, '---->', new_direction)
         print('Origin:', old_origin, '---->', new_origin)
         print('Spacing:', old_spacing, '---->', new_spacing)
@@ -46,6 +39,56 @@ def reformat_to_axial(image_volume, print_results=True):
     return image_volume
 
 
+def permute_to_axial(image_volume, tolerance=1e-6):
+    """Reformat a volume whose direction cosines are all (within tolerance) 0 or +/-1 to identity direction by
+    swapping and flipping its voxel array axes, without interpolation. Voxels keep their exact values and physical
+    locations: the new origin is the physical point of the voxel that ends up first. Returns None if the volume
+    isn't orthogonal"""
+    direction = np.reshape(image_volume.GetDirection(), (3, 3))  # column a is the direction of index axis a
+    if not np.allclose(np.abs(direction), np.round(np.abs(direction)), rtol=0, atol=tolerance) \
+            or not np.array_equal(np.sort(np.abs(direction).argmax(axis=1)), np.arange(3)):
+        return None
+    axes = np.abs(direction).argmax(axis=1)  # index axis along each of x, y and z
+    flips = direction[np.arange(3), axes] < 0
+
+    # NumPy array axes are in reverse order (z, y, x) of index axes
+    array = sitk.GetArrayViewFromImage(image_volume)
+    array = np.transpose(array, [2 - axes[p] for p in (2, 1, 0)])
+    array = array[tuple(slice(None, None, -1) if flips[p] else slice(None) for p in (2, 1, 0))]
+
+    first = [0, 0, 0]
+    for p in range(3):
+        if flips[p]:
+            first[axes[p]] = image_volume.GetSize()[axes[p]] - 1
+
+    axial_volume = sitk.GetImageFromArray(array)
+    axial_volume.SetSpacing(tuple(image_volume.GetSpacing()[a] for a in axes))
+    axial_volume.SetOrigin(image_volume.TransformIndexToPhysicalPoint(first))
+    return axial_volume
+
+
+def resample_to_axial(image_volume):
+    """Reformat a coronal volume to axial by resampling it (linear interpolation) on to an axial grid"""
+    spacing = (image_volume.GetSpacing()[0], image_volume.GetSpacing()[2],
+               image_volume.GetSpacing()[1])
+    size = (image_volume.GetSize()[0], image_volume.GetSize()[2], image_volume.GetSize()[1])
+    direction = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+    # lowest row of voxels is (size - 1) rows below the origin
+    origin = (image_volume.GetOrigin()[0], image_volume.GetOrigin()[1],
+              image_volume.GetOrigin()[2] - image_volume.GetSpacing()[1] * (image_volume.GetSize()[1] - 1))
+
+    resample = sitk.ResampleImageFilter()
+    resample.SetOutputSpacing(spacing)
+    resample.SetSize(size)
+    resample.SetOutputDirection(direction)
+    resample.SetOutputOrigin(origin)
+    resample.SetTransform(sitk.Transform())
+    resample.SetDefaultPixelValue(0)
+    resample.SetInterpolator(sitk.sitkLinear)
+    return resample.Execute(image_volume)
+
+
 def stitch(unstitched_images: list, slice_location: float):
     # make the 2D "coronal" images 3D coronal images:
     images_3d = [get_3d_image(i, slice_location) for i in unstitched_images]
@@ -57,12 +100,7 @@ def stitch(unstitched_images: list, slice_location: float):
     bottom_cropped_images = remove_bottom_overlap(images_3d)
 
     # remove top overlapping region from each image:
-    top_cropped_images = [images_3d[0]]
-    for i in range(1, len(images_3d)):
-        size = images_3d[i].GetOrigin()[2] - (
-                    images_3d[i - 1].GetOrigin()[2] - images_3d[i - 1].GetSize()[1] * images_3d[i - 1].GetSpacing()[1])
-        size = size / images_3d[0].GetSpacing()[1]
-        top_cropped_images.append(images_3d[i][:, round(size):, :])
+    top_cropped_images = [image[:, rows, :] for image, rows in zip(images_3d, top_overlap_rows(images_3d))]
 
     bottom_cropped_combined_image = combine_stations(bottom_cropped_images)
     top_cropped_combined_image = combine_stations(top_cropped_images)
@@ -76,13 +114,142 @@ def stitch(unstitched_images: list, slice_location: float):
     return sitk.Cast(stitched_image_2d, sitk.sitkUInt16)   
 
 
-def remove_bottom_overlap(images):
-    bottom_cropped_images = []
+def stitch_stations(stations, images, slice_location, batch_size=8, workers=None):
+    """Stitch all slice positions of a coronal volume at once. stations is a (stations, slices, rows, cols) uint16
+    array and images the 2D images of each station at one slice position, in the same order, giving the station
+    geometry. The overlap geometry and interpolation weights are worked out once from images, then every slice is
+    stitched in vectorised batches, giving the same result as stitch. Batches are stitched concurrently by a pool of
+    threads if workers is set (NumPy releases the GIL, and the arrays needn't be copied to other processes). Returns
+    the (slices, rows, cols) uint16 array of stitched slices and their 2D origin and spacing, or None if the stations
+    aren't aligned to a common grid"""
+    images_3d = [get_3d_image(i, slice_location) for i in images]
+    order = sorted(range(len(images_3d)), key=lambda s: images_3d[s].GetOrigin()[2], reverse=True)
+    images_3d = [images_3d[s] for s in order]
+
+    samplings = []
+    for rows in (bottom_overlap_rows(images_3d), top_overlap_rows(images_3d)):
+        samplings.append(combined_sampling([(image[:, r, :], s, r) for image, s, r in zip(images_3d, order, rows)]))
+    if any(sampling is None for sampling in samplings) or samplings[0][0] != samplings[1][0]:
+        return None
+
+    stitched = np.empty((stations.shape[1], *samplings[0][0]), dtype=np.uint16)
+
+    def stitch_batch(start):
+        batch = stations[:, start:start + batch_size]
+        bottom, top = (combine_station_arrays(batch, sampling) for sampling in samplings)
+        # uint16 sum wraps as sitk.Add does, then the float division is truncated by the cast back to uint16
+        stitched[start:start + batch_size] = (bottom + top) // 2
+
+    starts = range(0, stations.shape[1], batch_size)
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(stitch_batch, starts))
+    else:
+        for start in starts:
+            stitch_batch(start)
+
+    origin = images_3d[0].GetOrigin()
+    return stitched, (origin[0], origin[2]), images_3d[0].GetSpacing()[:2]
+
+
+def combined_sampling(cropped):
+    """Shape (rows, cols) of the stations combined by combine_stations and how each station is sampled onto it.
+    cropped is a list of (3D image of the cropped station at one slice position, station index, rows of the station
+    kept). Returns None if a station isn't aligned to the combined grid"""
+    cropped = sorted(cropped, key=lambda c: c[0].GetOrigin()[2], reverse=True)
+    first, last = cropped[0][0], cropped[-1][0]
+    top = first.GetOrigin()[2]
+    bottom = last.GetOrigin()[2] - last.GetHeight() * last.GetSpacing()[1]
+    height = int((top - bottom) / first.GetSpacing()[1])
+    width = first.GetWidth()
+
+    stations = []
+    for image, s, rows in cropped:
+        sampling = station_sampling(image, first, width, height)
+        if sampling is None:
+            return None
+        (x0, x1, dx, columns), (y0, y1, dy, out_rows) = sampling
+        if columns.start < columns.stop and out_rows.start < out_rows.stop:
+            stations.append((s, rows, out_rows, columns, x0[columns], x1[columns], dx[columns], y0[out_rows],
+                             y1[out_rows], dy[out_rows, None]))
+    return (height, width), stations
+
+
+def combine_station_arrays(stations, sampling):
+    """Array version of combine_stations for a (stations, slices, rows, cols) array, sampled as given by
+    combined_sampling"""
+    shape, station_samplings = sampling
+    combined = np.zeros((stations.shape[1], *shape), dtype=np.uint16)
+    for s, rows, out_rows, columns, x0, x1, dx, y0, y1, dy in station_samplings:
+        m = stations[s, :, rows]
+        # interpolate along rows of station, then between them, in the same order as ITK
+        v0 = np.take(m, x0, axis=2).astype(float)
+        along_x = np.take(m, x1, axis=2).astype(float)
+        along_x -= v0
+        along_x *= dx
+        along_x += v0
+        vx0 = np.take(along_x, y0, axis=1)
+        values = np.take(along_x, y1, axis=1)
+        values -= vx0
+        values *= dy
+        values += vx0
+        # linear interpolation between uint16 values is in range, so the cast truncates as ITK's does
+        combined[:, out_rows, columns] += values.astype(np.uint16)
+    return combined
+
+
+def station_sampling(station, reference, width, height):
+    """Neighbouring pixels and weights along columns and along rows with which ResampleImageFilter (linear
+    interpolation, identity transform) samples station on the grid of reference with size (width, height, 1), and
+    the columns and rows of the grid inside station. Follows ITK's scanline walk: the continuous indices of the first
+    pixel of each row and of the pixel after its last are transformed, and those of the pixels in between
+    interpolated from them. Returns None if sampling along columns varies between rows, or the other way round"""
+    starts, ends = np.empty((height, 1, 3)), np.empty((height, 1, 3))
+    for j in range(height):
+        starts[j] = station.TransformPhysicalPointToContinuousIndex(reference.TransformIndexToPhysicalPoint((0, j, 0)))
+        ends[j] = station.TransformPhysicalPointToContinuousIndex(reference.TransformIndexToPhysicalPoint((width, j, 0)))
+    alpha = (np.arange(width) / width)[None, :, None]
+    c = starts + (ends - starts) * alpha
+
+    # index along columns the same for every row, along rows the same for every column, and slice index in range
+    if not ((c[..., 0] == c[:1, :, 0]).all() and (c[..., 1] == c[:, :1, 1]).all()
+            and ((c[..., 2] >= -0.5) & (c[..., 2] < 0.5)).all()):
+        return None
+    sampling = []
+    for c_axis, size in ((c[0, :, 0], station.GetWidth()), (c[:, 0, 1], station.GetHeight())):
+        inside = np.flatnonzero((c_axis >= -0.5) & (c_axis < size - 0.5))
+        # the index increases along the axis, so the pixels inside are a contiguous range
+        pixels = slice(inside[0], inside[-1] + 1) if len(inside) else slice(0, 0)
+        base = np.maximum(np.floor(c_axis), 0)
+        distance = np.maximum(c_axis - base, 0)
+        base = np.minimum(base, size - 1).astype(np.intp)
+        sampling.append((base, np.minimum(base + 1, size - 1), distance, pixels))
+    return sampling
+
+
+def bottom_overlap_rows(images):
+    """Rows of each image (sorted in descending order of z location) above the top of the image below it"""
+    rows = []
     for i in range(len(images) - 1):
         size = (images[i].GetOrigin()[2] - (images[i + 1].GetOrigin()[2])) / images[0].GetSpacing()[1]
-        bottom_cropped_images.append(images[i][:, :round(size), :])
-    bottom_cropped_images.append(images[-1])
-    return bottom_cropped_images
+        rows.append(slice(None, round(size)))
+    rows.append(slice(None))
+    return rows
+
+
+def top_overlap_rows(images):
+    """Rows of each image (sorted in descending order of z location) below the bottom of the image above it"""
+    rows = [slice(None)]
+    for i in range(1, len(images)):
+        size = images[i].GetOrigin()[2] - (
+                    images[i - 1].GetOrigin()[2] - images[i - 1].GetSize()[1] * images[i - 1].GetSpacing()[1])
+        size = size / images[0].GetSpacing()[1]
+        rows.append(slice(round(size), None))
+    return rows
+
+
+def remove_bottom_overlap(images):
+    return [image[:, rows, :] for image, rows in zip(images, bottom_overlap_rows(images))]
 
 
 def get_3d_image(image, slice_location):
@@ -123,9 +290,9 @@ def split_volume_into_stations(vol, num_stations=3, overlap=0.01):
 
 
 def remove_empty_slices(station):
-    array = sitk.GetArrayFromImage(station)
     height = station.GetHeight()
-    empty_slices = [s for s in range(height) if array[:, s, :].max() == 0]
+    # rows (y) whose every pixel is zero, found in one reduction over the other axes
+    empty_slices = np.flatnonzero(sitk.GetArrayViewFromImage(station).max(axis=(0, 2)) == 0).tolist()
     if empty_slices:
         lower = max(empty_slices) + 1 if max(empty_slices) < height/2 else 0
         upper = min(empty_slices) if min(empty_slices) > height/2 else height
@@ -133,10 +300,44 @@ def remove_empty_slices(station):
     return station
 
 
-def register_stations_in_volume(volume, reference, num_stations):
+def register_stations_in_volume(volume, reference, num_stations, cache=None, workers=None, shrink_factors=None,
+                                smoothing_sigmas=None, print_results=True):
+    """Register each station of volume to the same station of reference and combine the registered stations. With
+    workers, stations are registered concurrently in that many threads, sharing ITK's threads between them.
+    Multi-resolution if shrink_factors (and smoothing_sigmas in mm) are given per level, coarsest first. The cache is
+    only used from the calling thread, as its SQLite connection can't be shared"""
     ref_stations = split_volume_into_stations(reference, num_stations=num_stations)
     stations = split_volume_into_stations(volume, num_stations=num_stations)
-    stations_registered = list(map(register_station, ref_stations, stations))
+    pairs = [tuple(sitk.Cast(image, sitk.sitkFloat32) for image in pair) for pair in zip(ref_stations, stations)]
+
+    keys = [station_key(f, m, shrink_factors, smoothing_sigmas) if cache is not None else None for f, m in pairs]
+    results = [cache.lookup(key) if key is not None else None for key in keys]
+    threads = max(1, sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() // workers) if workers else None
+
+    def register(pair, result):
+        if result is None:
+            return calculate_station_translation(*pair, shrink_factors, smoothing_sigmas, threads)
+        return result[0], result[2], result[3], None
+
+    start = time.perf_counter()
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(register, pairs, results))
+    else:
+        results = list(map(register, pairs, results))
+    duration = time.perf_counter() - start
+
+    round_tuple = lambda t, n=2: tuple(round(e, n) for e in t)
+    for i, (key, (parameters, metric_value, iterations, station_duration)) in enumerate(zip(keys, results)):
+        if station_duration is not None and cache is not None:
+            cache.update(key, parameters, [], metric_value, iterations, None)
+        if print_results:
+            timing = 'cached' if station_duration is None else f'{iterations} iterations, {station_duration:.2f} s'
+            print(f'Station {i}: Translation (mm) (x,y,z) = {round_tuple(parameters)}, {timing}')
+    if print_results:
+        print(f'Registered {len(pairs)} stations in {duration:.2f} s')
+
+    stations_registered = [move_station(f, m, result[0]) for (f, m), result in zip(pairs, results)]
     stations_registered = list(map(remove_empty_slices, stations_registered))
     stations_registered = remove_bottom_overlap(stations_registered)
     volume_registered = combine_stations(stations_registered)
@@ -0,0 +1,126 @@
+import time
+from functools import partial
+import numpy as np
+import pydicom
+from pydicom.tag import Tag
+from pydicom.filereader import read_partial
+from pydicom.errors import InvalidDicomError
+import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from identify_dicom import DICOMName
+
+# tags needed to classify a file with DICOMName and add it to a volume as a slice
+HEADER_TAGS = [Tag(t) for t in ['SpecificCharacterSet', 'SequenceName', 'ImageType', 'ManufacturerModelName',
+                                'ScanOptions', 'EchoTime', 'SeriesDescription', (0x0019, 0x0010), (0x0019, 0x100c),
+                                'SoftwareVersions', 'MRDiffusionSequence', 'StudyInstanceUID', 'SeriesInstanceUID',
+                                'ImagePositionPatient', 'ImageOrientationPatient',
+                                'SliceThickness']]  # (0019,xxxx): Siemens B-Value
+
+
+def is_dicom_file(path):
+    """Cheap check for the 'DICM' prefix after the 128 byte preamble, which pydicom also requires"""
+    with open(path, 'rb') as f:
+        f.seek(128)
+        return f.read(4) == b'DICM'
+
+
+def read_dcm_header(path, tags=None):
+    """Read DCM file header and identify dicom scan type, returning (path, header, series name). If tags is set,
+    only those tags are kept and reading stops after the last of them, skipping eg. private Siemens CSA headers"""
+    if not is_dicom_file(path):
+        return path, None, None
+
+    try:
+        if tags:
+            last_tag = max(tags)
+            with open(path, 'rb') as f:
+                dcm_header = read_partial(f, stop_when=lambda tag, vr, length: tag > last_tag, specific_tags=tags)
+        else:
+            dcm_header = pydicom.dcmread(path, stop_before_pixels=True)
+    except InvalidDicomError:
+        return path, None, None
+
+    name = DICOMName(dcm_header)
+    return path, dcm_header, name.series if name else None
+
+
+def scan_dcm_headers(paths, workers=None, executor='thread', tags=None):
+    """Yield (path, header, series name) for each path, in the same order as paths. Headers are read
+    concurrently across a thread or process pool if workers is set, otherwise sequentially"""
+    read = partial(read_dcm_header, tags=tags)
+    if not workers:
+        yield from map(read, paths)
+        return
+
+    if executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=workers)
+    elif executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f"Unknown executor '{executor}', use 'thread' or 'process'")
+
+    with pool:
+        # executor.map returns results in submission order, so the merge into volumes is deterministic
+        chunksize = max(1, len(paths) // (workers * 8)) if executor == 'process' else 1
+        yield from pool.map(read, paths, chunksize=chunksize)
+
+
+def read_dcm_series(paths):
+    """Read the pixel data of DCM files in one batched call, returning a uint16 array of shape (slices, rows, cols),
+    the image position (patient) of each slice, the in-plane spacing and a metadata reader for the first file.
+    Raises RuntimeError if the files don't all have the same matrix size, see group_dcm_series"""
+    series_reader = sitk.ImageSeriesReader()
+    series_reader.SetImageIO('GDCMImageIO')
+    series_reader.SetOutputPixelType(sitk.sitkUInt16)
+    series_reader.SetFileNames(paths)
+    series_reader.MetaDataDictionaryArrayUpdateOn()
+    # files aren't in slice order, so silence ITK's non-uniform sampling warning while reading
+    warning_display = sitk.ProcessObject.GetGlobalWarningDisplay()
+    sitk.ProcessObject.SetGlobalWarningDisplay(False)
+    try:
+        vol = series_reader.Execute()
+    finally:
+        sitk.ProcessObject.SetGlobalWarningDisplay(warning_display)
+    array = sitk.GetArrayFromImage(vol)
+
+    positions = np.array([[float(p) for p in series_reader.GetMetaData(i, '0020|0032').split('\\')]
+                          for i in range(len(paths))])
+
+    # https://discourse.itk.org/t/set-photometric-interpretation-for-gdcmimageio-as-monochrome2-in-simpleitk/3073/6
+    monochrome1 = np.array([series_reader.GetMetaData(i, '0028|0004').strip() == 'MONOCHROME1'
+                            for i in range(len(paths))])
+    if monochrome1.any():
+        array[monochrome1] = array[monochrome1].max(axis=(1, 2), keepdims=True) - array[monochrome1]
+
+    # keep one reader for volume to make writing DICOMs easy, pixel data isn't needed for this
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    reader.SetFileName(paths[0])
+    reader.ReadImageInformation()
+
+    return array, positions, vol.GetSpacing()[:2], reader
+
+
+def group_dcm_series(paths):
+    """Indices of paths grouped by image size (columns, rows), read from the file headers only, so that a series
+    with slices of different matrix sizes can be read as one batched series per size"""
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    groups = {}
+    for i, path in enumerate(paths):
+        reader.SetFileName(path)
+        reader.ReadImageInformation()
+        groups.setdefault(reader.GetSize()[:2], []).append(i)
+    return list(groups.values())
+
+
+def time_header_reading(paths, repeats=3):
+    """Print the mean per-file cost of reading and classifying headers, full header vs. HEADER_TAGS only"""
+    paths = list(paths)
+    for description, tags in [('full header', None), ('header tags only', HEADER_TAGS)]:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for path in paths:
+                read_dcm_header(path, tags=tags)
+        per_file = (time.perf_counter() - start) / (repeats * len(paths))
+        print(f'{description}: {per_file * 1000:.3f} ms per file ({len(paths)} files)')
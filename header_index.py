@@ -0,0 +1,87 @@
+import os
+import sqlite3
+from pydicom.dataset import Dataset
+
+INDEX_VERSION = 1  # bump whenever the stored fields or the DICOMName rules change, so stale indexes are rebuilt
+
+
+class HeaderIndex:
+    """Persistent SQLite index of classified DICOM headers for a session folder, keyed by file path, size and
+    modification time. Stores just enough of each header to build volumes without re-reading the file."""
+
+    def __init__(self, session_path):
+        self.path = self.index_path(session_path)
+        self.connection = sqlite3.connect(self.path)
+        try:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS headers')
+            # always written, so a read-only index fails here rather than part way through loading
+            self.connection.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+        except sqlite3.OperationalError:
+            self.connection.close()
+            raise
+        self.connection.execute('CREATE TABLE IF NOT EXISTS headers ('
+                                'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, series TEXT, '
+                                'study_uid TEXT, position TEXT, orientation TEXT, slice_thickness TEXT)')
+        self.rows = {row[0]: row[1:] for row in self.connection.execute('SELECT * FROM headers')}
+
+    @classmethod
+    def open(cls, session_path):
+        """HeaderIndex of the session, or None if it can't be opened for writing, eg. in a read-only folder"""
+        try:
+            return cls(session_path)
+        except sqlite3.OperationalError as error:
+            print(f' Header index not available ({error}), reading all file headers')
+            return None
+
+    @staticmethod
+    def index_path(session_path):
+        """Index file sits next to the session folder, eg. 'mr_id/input' -> 'mr_id/input_header_index.sqlite'"""
+        return os.path.normpath(session_path) + '_header_index.sqlite'
+
+    def lookup(self, path):
+        """Return (header, series name) from the index if the file is unchanged since it was indexed, else None.
+        Non-DICOM and unclassified files are indexed with header and series name of None"""
+        row = self.rows.get(path)
+        if row is None:
+            return None
+        stat = os.stat(path)
+        size, mtime, series, study_uid, position, orientation, slice_thickness = row
+        if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        if series is None:
+            return None, None
+
+        dcm_header = Dataset()
+        dcm_header.StudyInstanceUID = study_uid
+        dcm_header.ImagePositionPatient = [float(p) for p in position.split('\\')]
+        dcm_header.ImageOrientationPatient = [float(o) for o in orientation.split('\\')]
+        dcm_header.SliceThickness = slice_thickness
+        return dcm_header, series
+
+    def update(self, path, dcm_header, series):
+        stat = os.stat(path)
+        row = (stat.st_size, stat.st_mtime_ns, series, None, None, None, None)
+        if series is not None:
+            row = (stat.st_size, stat.st_mtime_ns, series, dcm_header.StudyInstanceUID,
+                   '\\'.join(map(str, dcm_header.ImagePositionPatient)),
+                   '\\'.join(map(str, dcm_header.ImageOrientationPatient)), str(dcm_header.SliceThickness))
+        self.rows[path] = row
+        self.connection.execute('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (path, *row))
+
+    def prune(self, paths):
+        """Remove entries for files that no longer exist in the session folder"""
+        removed = self.rows.keys() - set(paths)
+        for path in removed:
+            del self.rows[path]
+        self.connection.executemany('DELETE FROM headers WHERE path = ?', [(p,) for p in removed])
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
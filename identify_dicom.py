@@ -1,8 +1,40 @@
+_MISSING = object()  # stands in for tags absent from the header, which the rules treat differently to empty tags
+
+
 class DICOMName:
+    # Classifications memoised per series, shared by all instances (eg. when loading a VolumeCollection or in
+    # XNATDownloader.identify_scans). SeriesInstanceUID alone isn't a safe key as one series can hold images get_name
+    # names differently (eg. b-values of a TRACEW series, echoes of a Dixon series, TRACEW and ADC images), so the key
+    # holds every tag get_name reads, and the scanner model and software version the rules depend on.
+    cache = {}
+    # SeriesInstanceUID, ManufacturerModelName, SoftwareVersions, SequenceName, ImageType, ScanOptions, EchoTime,
+    # SeriesDescription, Siemens b-value and MRDiffusionSequence
+    key_tags = [(0x20, 0x0e), (0x08, 0x1090), (0x18, 0x1020), (0x18, 0x24), (0x08, 0x08), (0x18, 0x22),
+                (0x18, 0x81), (0x08, 0x103e), (0x19, 0x100c), (0x18, 0x9117)]
+
     def __init__(self, dcm_header):
         self.sequence = None
         self.series = None
-        self.get_name(dcm_header)
+        key = self.classification_key(dcm_header)
+        if key is None:
+            self.get_name(dcm_header)
+        elif key in self.cache:
+            self.sequence, self.series = self.cache[key]
+        else:
+            self.get_name(dcm_header)
+            self.cache[key] = self.sequence, self.series
+
+    @classmethod
+    def classification_key(cls, dcm_header):
+        """Key of the values of every tag the classification depends on, or None (not memoised) if the header has no
+        SeriesInstanceUID. Values are used as read, undecoded if the header hasn't decoded them yet, so the key costs
+        much less than get_name"""
+        key = tuple(_key_value(dcm_header.get_item(tag)) for tag in cls.key_tags)
+        return None if key[0] is _MISSING else key
+
+    @classmethod
+    def clear_cache(cls):
+        cls.cache.clear()
 
     def get_name(self, dcm_header):
         try:
@@ -79,6 +111,17 @@ class DICOMName:
         return bool(self.sequence and self.series)
 
 
+def _key_value(element):
+    """Hashable value of a data element for a classification key, raw bytes for an element that hasn't been decoded"""
+    if element is None:
+        return _MISSING
+    try:
+        hash(element.value)
+        return element.value
+    except TypeError:  # eg. decoded sequences and multi-valued elements
+        return str(element.value)
+
+
 
 
 
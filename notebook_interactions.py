@@ -64,8 +64,12 @@ class RegistrationDashboard:
         display(self.plot_output)
 
     def update_smooth(self, *args, **kwargs):
+        # only refits the axis whose parameters changed and updates the existing plot lines, so sliders stay responsive
         self.registration.smooth(**kwargs)
-        self.plot()
+        self.registration.update_plot()
+        self.plot_output.clear_output(wait=True)
+        with self.plot_output:
+            display(self.registration.figure)
 
     def fill_slider_grid(self):
         self.slider_grid[0, 0] = widgets.IntSlider(min=1, max=50, value=15, description="x Kernal width",
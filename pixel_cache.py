@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def image_nbytes(image):
+    return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+
+class PixelCache:
+    """Least recently used cache of decoded slice images (and the registration images prepared from them), shared by
+    all volumes in a collection. Once the memory budget is exceeded, images of the least recently used slices are
+    evicted; they are re-read from their DICOM file on next access"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.slices = OrderedDict()
+        self.pins = 0
+
+    def add(self, s, image):
+        nbytes = image_nbytes(image)
+        self.discard(s)
+        self.slices[s] = nbytes
+        self.nbytes += nbytes
+        self.evict()
+
+    def charge(self, s, nbytes):
+        """Count nbytes more (or less, if negative) memory held by a tracked slice, eg. its registration images, so
+        they are counted against the budget and evicted with the slice"""
+        if s in self.slices:
+            self.slices[s] += nbytes
+            self.nbytes += nbytes
+            self.slices.move_to_end(s)
+            self.evict()
+
+    def touch(self, s):
+        if s in self.slices:
+            self.slices.move_to_end(s)
+
+    def discard(self, s):
+        """Stop tracking slice, eg. when its image has been modified and can no longer be re-read from file"""
+        self.nbytes -= self.slices.pop(s, 0)
+
+    @contextmanager
+    def pinned(self):
+        """Defer evictions until exit, eg. while a batch of slice arrays is built, so that slices read for the batch
+        aren't evicted (and re-read) before it is complete"""
+        self.pins += 1
+        try:
+            yield
+        finally:
+            self.pins -= 1
+            self.evict()
+
+    def evict(self):
+        if self.pins:
+            return
+        while self.nbytes > self.max_bytes and len(self.slices) > 1:  # always keep the most recently used
+            s, nbytes = self.slices.popitem(last=False)
+            self.nbytes -= nbytes
+            s.evict()
+
+    def __len__(self):
+        return len(self.slices)
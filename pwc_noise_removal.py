@@ -1,36 +1,96 @@
 import math
+import time
 import numpy as np
-from more_itertools import run_length
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def per_signal(value, num_signals):
+    """Broadcast a parameter given once or per signal to an array with one value per signal"""
+    return np.broadcast_to(np.asarray(value), (num_signals,))
 
 
 def rolling_median(x, k=15, padding=False):
-    xm = [np.median(x[i:i + k]) for i in range(len(x) - k + 1)]  # rolling median of kernel length k
-    pad_len = math.floor(k / 2)
-    if padding:
-        xm = ([xm[0]] * pad_len) + xm + ([xm[-1]] * (k - pad_len - 1))  # pad with end values
-    else:
-        xm = ([np.nan] * pad_len) + xm + ([np.nan] * (k - pad_len - 1))  # pad with nans
-    return xm
+    """Rolling median of kernel length k, centred on each point, of a signal or of each row of a 2D array of signals
+    (k can be given per signal). The medians of all windows of all signals are taken in one call on a sliding window
+    view, without copying windows out. Ends are padded with nans, or with the end values if padding is set"""
+    x = np.asarray(x, dtype=float)
+    signals = np.atleast_2d(x)
+    n = signals.shape[1]
+    xm = np.full(signals.shape, np.nan)
+    ks = per_signal(k, len(signals))
+    for kernel in np.unique(ks):  # one call for every signal with the same kernel length
+        rows = np.flatnonzero(ks == kernel)
+        if n < kernel:
+            continue
+        pad_len = math.floor(kernel / 2)
+        # window x[i:i + k] is placed at i + pad_len
+        xm[rows, pad_len:pad_len + n - kernel + 1] = np.median(sliding_window_view(signals[rows], kernel, axis=1),
+                                                               axis=2)
+        if padding:  # pad with end values
+            xm[rows, :pad_len] = xm[rows, pad_len, None]
+            xm[rows, pad_len + n - kernel + 1:] = xm[rows, pad_len + n - kernel, None]
+    return xm if x.ndim > 1 else xm[0]
 
 
-def fit_steps(x: list, k: int = 15, threshold=98, min_step_length=0):
-    """Remove noise from a piecewise constant (PWC) signal"""
+def fit_steps(x, k=15, threshold=98, min_step_length=0):
+    """Remove noise from a piecewise constant (PWC) signal, or from each row of a 2D array of signals at once.
+    k, threshold and min_step_length can be given once or per signal. Returns a NumPy array shaped like x"""
     # inspired by: https://stats.stackexchange.com/questions/377310/how-to-fit-a-robust-step-function-to-a-time-series
+    x = np.asarray(x, dtype=float)
+    signals = np.atleast_2d(x)
+    num_signals, n = signals.shape
     # 1. Smooth signal with rolling median
-    xm = rolling_median(x, k)
-    # 2. Calculate threshold for steps
-    diffs = abs(np.diff(xm))
-    threshold = np.nanpercentile(diffs, threshold)
-    # 3. Find step locations using threshold
-    steps = np.nan_to_num(diffs) > threshold
-    step_locs = np.nonzero(steps)[0] + 1
-    step_locs = np.concatenate([[0], step_locs, [len(x)]])
-    # 4. remove steps that are closer than min-step length:
-    step_locs = [step_locs[i-1] for i in range(1, len(step_locs)) if step_locs[i] - step_locs[i-1] >= min_step_length]
-    step_locs = np.concatenate([step_locs,[len(x)]])
-    # 5. Find medians between steps
-    step_medians = [np.median(x[step_locs[i-1]:step_locs[i]]) for i in range(1, len(step_locs))]
+    xm = rolling_median(signals, per_signal(k, num_signals))
+    # 2. Calculate threshold for steps (signals shorter than k have no steps)
+    diffs = np.abs(np.diff(xm, axis=1))
+    thresholds = np.full(num_signals, np.inf)
+    for i, (d, t) in enumerate(zip(diffs, per_signal(threshold, num_signals))):
+        if not np.isnan(d).all():
+            thresholds[i] = np.nanpercentile(d, t)
+    # 3. Find step locations using threshold, the first point of each signal starts a step
+    starts = np.zeros(signals.shape, dtype=bool)
+    starts[:, 0] = True
+    starts[:, 1:] = np.nan_to_num(diffs) > thresholds[:, None]
+    # 4. remove steps that are closer than min-step length, ie. merge short steps into the step before them
+    rows, cols = np.nonzero(starts)
+    ends = np.append(cols[1:], n)
+    ends[np.flatnonzero(np.diff(rows))] = n  # last step of each signal ends at the end of the signal
+    short = (ends - cols) < per_signal(min_step_length, num_signals)[rows]
+    short[cols == 0] = False
+    starts[rows[short], cols[short]] = False
+    # 5. Find medians between steps, sorting values within each step of every signal together
+    step_ids = np.cumsum(starts.ravel()) - 1
+    values = signals.ravel()[np.lexsort((signals.ravel(), step_ids))]
+    step_starts = np.flatnonzero(starts.ravel())
+    step_lengths = np.diff(np.append(step_starts, values.size))
+    step_medians = (values[step_starts + (step_lengths - 1) // 2] + values[step_starts + step_lengths // 2]) / 2
     # 6. Recreate signal
-    step_lengths = list(np.diff(step_locs))
-    xms = list(run_length.decode((zip(step_medians, step_lengths))))
-    return xms
\ No newline at end of file
+    xms = step_medians[step_ids].reshape(signals.shape)
+    return xms if x.ndim > 1 else xms[0]
+
+
+def benchmark(lengths=(100, 1000, 10000), num_volumes=50, num_slices=200, repeats=3):
+    """Print the time taken by fit_steps on long slice stacks, and on the x and y translations of many volumes
+    smoothed in one call vs. one call per signal"""
+    rng = np.random.default_rng(0)
+
+    def pwc(shape):
+        # piecewise constant signals with noise
+        steps = rng.normal(0, 2, shape) * (rng.random(shape) < 0.02)
+        return np.cumsum(steps, axis=-1) + rng.normal(0, 0.3, shape)
+
+    def timed(f):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            f()
+        return (time.perf_counter() - start) / repeats * 1000
+
+    for n in lengths:
+        signal = pwc(n)
+        print(f'{n} slices: {timed(lambda: fit_steps(signal, k=15, min_step_length=30)):.2f} ms')
+
+    signals = pwc((num_volumes * 2, num_slices))
+    batched = timed(lambda: fit_steps(signals, k=15, min_step_length=30))
+    separately = timed(lambda: [fit_steps(s, k=15, min_step_length=30) for s in signals])
+    print(f'{num_volumes} volumes x and y ({num_slices} slices): {batched:.2f} ms in one call, '
+          f'{separately:.2f} ms one signal at a time')
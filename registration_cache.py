@@ -0,0 +1,83 @@
+import os
+import hashlib
+import sqlite3
+import numpy as np
+
+CACHE_VERSION = 2  # bump whenever the registration method or stored fields change, so stale results are dropped
+
+
+def content_key(*items):
+    """SHA-256 hex digest of arrays (dtype, shape and pixel data) and other values (by repr), used to key results by
+    the content of the images registered and the parameters used rather than by file or slice"""
+    digest = hashlib.sha256()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            digest.update(f'{item.dtype}{item.shape}'.encode())
+            digest.update(np.ascontiguousarray(item).data)
+        else:
+            digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+class RegistrationCache:
+    """Persistent SQLite cache of registration results for a session folder, keyed by content_key of the fixed and
+    moving images and the registration parameters. Stores the final transform parameters and the metric trace, so
+    registrations that have already been run (eg. before a kernel restart) become lookups"""
+
+    def __init__(self, session_path):
+        self.path = self.cache_path(session_path)
+        self.connection = sqlite3.connect(self.path)
+        try:
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] != CACHE_VERSION:
+                self.connection.execute('DROP TABLE IF EXISTS results')
+            # always written, so a read-only cache fails here rather than part way through registration
+            self.connection.execute(f'PRAGMA user_version = {CACHE_VERSION}')
+        except sqlite3.OperationalError:
+            self.connection.close()
+            raise
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                'key TEXT PRIMARY KEY, parameters BLOB, metric BLOB, metric_value REAL, '
+                                'iterations INTEGER, stop_condition TEXT)')
+
+    @classmethod
+    def open(cls, session_path):
+        """RegistrationCache of the session, or None if it can't be opened for writing, eg. in a read-only folder"""
+        try:
+            return cls(session_path)
+        except sqlite3.OperationalError as error:
+            print(f' Registration cache not available ({error}), registering without it')
+            return None
+
+    @staticmethod
+    def cache_path(session_path):
+        """Cache file sits next to the session folder, eg. 'mr_id/input' -> 'mr_id/input_registration_cache.sqlite'"""
+        return os.path.normpath(session_path) + '_registration_cache.sqlite'
+
+    def lookup(self, key):
+        """Return (transform parameters, metric trace, final metric value, iterations, stop condition) stored for key,
+        else None"""
+        row = self.connection.execute('SELECT parameters, metric, metric_value, iterations, stop_condition '
+                                      'FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        parameters, metric, metric_value, iterations, stop_condition = row
+        return (tuple(np.frombuffer(parameters).tolist()), np.frombuffer(metric).tolist(), metric_value, iterations,
+                stop_condition)
+
+    def update(self, key, parameters, metric, metric_value, iterations=None, stop_condition=None):
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                                (key, np.asarray(parameters, dtype=float).tobytes(),
+                                 np.asarray(metric, dtype=float).tobytes(), metric_value, iterations, stop_condition))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
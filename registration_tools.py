@@ -1,9 +1,29 @@
 import SimpleITK as sitk
+import numpy as np
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pwc_noise_removal import fit_steps
 from notebook_interactions import RegistrationDashboard
+from registration_cache import content_key
+
+ENGINES = ['mi', 'fft', 'fft+mi']
+NUM_BINS, SAMPLING_PERCENTAGE = 50, 0.5
+LEARNING_RATE, MIN_STEP, NUM_ITER = 1.0, .001, 200
+# part of the key of cached results, so results are only reused for the same registration settings
+REGISTRATION_SETTINGS = ('mattes', NUM_BINS, SAMPLING_PERCENTAGE, 'regular step', LEARNING_RATE, MIN_STEP, NUM_ITER)
+# keyword arguments of SliceTranslation.set_registration_parameters, split from smoothing kwargs in __call__
+REGISTRATION_PARAMETERS = ('shrink_factors', 'smoothing_sigmas', 'level_iterations', 'trace', 'plateau_window',
+                           'plateau_tolerance')
+# optimiser stop condition descriptions and the short names used in telemetry
+STOP_CONDITIONS = {'Step too small': 'min_step', 'Maximum number of iterations': 'max_iterations',
+                   'Gradient magnitude tolerance': 'gradient', 'Convergence checker': 'convergence'}
+# SliceTranslation fields that make up one registration result, restored together by keep_better
+RESULT_FIELDS = ('transformation', 'metric', 'metric_value', 'iterations', 'stop_condition', 'duration', 'cached',
+                 'cache_key')
+TELEMETRY_DTYPE = np.dtype([('slice_location', 'f8'), ('iterations', 'i4'), ('stop_condition', 'U16'),
+                            ('metric', 'f8'), ('duration', 'f8'), ('cached', '?')])
 
 
 class VolumeSliceTranslation:
@@ -14,6 +34,12 @@ class VolumeSliceTranslation:
         self._reference_volume = None
         self.x = []
         self.y = []
+        self.iterations = 0  # total optimiser iterations and wall time (s) of the last calculate
+        self.duration = 0
+        self.raw = None  # (x, y) translations of each slice as calculated, before smoothing
+        self.smoothed = {}  # (axis, k, threshold, min_step_length): fit_steps result, for the current raw
+        self.figure = None
+        self.lines = []
         self.dashboard = RegistrationDashboard(self)
 
     @property
@@ -30,20 +56,116 @@ class VolumeSliceTranslation:
         for s, r in zip(self.volume.slices, self.reference_volume.slices):
             s.registration.fixed = r
 
-    def calculate(self, log=False, external_bar=None):
+    @property
+    def cache(self):
+        """RegistrationCache of the volume's collection, None if it doesn't keep one"""
+        collection = self.volume.vol_collection
+        return collection.registration_cache if collection is not None else None
+
+    def calculate(self, log=False, external_bar=None, workers=None, seed=None, engine='mi', propagate=False,
+                  bidirectional=False, use_cache=True, **parameters):
+        """Calculate translation of each slice to its reference slice. engine is 'mi' (mutual information
+        registration), 'fft' (phase correlation estimate of all slices at once) or 'fft+mi' (mutual information
+        registration starting from the phase correlation estimate). If workers is set the slices are registered
+        across a pool of worker processes. Set seed to fix the metric sampling seed, making results repeatable.
+        If propagate is set, each slice's registration starts from the previous slice's translation, bidirectional
+        adds a backward pass keeping whichever result has the better metric. If use_cache is set, slices registered
+        before with the same images and parameters take their result from the collection's RegistrationCache.
+        Other parameters (eg. multi-resolution schedule) are passed to SliceTranslation.set_registration_parameters"""
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', use one of {ENGINES}")
+        if 'level_iterations' in parameters:
+            parameters['level_iterations'] = level_iteration_caps(parameters['level_iterations'],
+                                                                  parameters.get('shrink_factors'))
+        if propagate and (workers or engine != 'mi'):
+            raise ValueError("Propagated registration runs slice by slice with the 'mi' engine, it can't be used with "
+                             "workers or another engine")
         if not external_bar:
             print(f'Calculating translation transform of {self.volume.name} to {self.reference_volume.name}')
             time.sleep(.3)
-            with tqdm(total=len(self.volume)) as pbar:
-                for s, r in zip(self.volume.slices, self.reference_volume.slices):
-                    s.registration.calculate_transformation(log=log)
+
+        self.iterations, start = 0, time.perf_counter()
+        cache = self.cache if use_cache else None
+        total = len(self.volume) * (2 if propagate and bidirectional else 1)
+        with tqdm(total=total, disable=bool(external_bar)) as pbar:
+            for s in self.iter_calculate(log=log, workers=workers, seed=seed, engine=engine, propagate=propagate,
+                                         bidirectional=bidirectional, cache=cache, **parameters):
+                if not s.registration.cached:
+                    self.iterations += s.registration.iterations
+                if external_bar:
+                    external_bar.value += 1
+                else:
                     pbar.set_postfix(refresh=True)
                     pbar.update()
-
-        else:
-            for s, r in zip(self.volume.slices, self.reference_volume.slices):
-                s.registration.calculate_transformation(log=log)
-                external_bar.value += 1
+        self.duration = time.perf_counter() - start
+        self.reset_translations()
+        if cache is not None:
+            cache.commit()
+
+    def iter_calculate(self, log=False, workers=None, seed=None, engine='mi', propagate=False, bidirectional=False,
+                       cache=None, **parameters):
+        """Calculate translation of each slice, yielding each slice once its registration has finished"""
+        if engine == 'fft':
+            for s, translation in zip(self.volume.slices, self.estimate_translations(log=log)):
+                s.registration.set_result(translation, [], stop_condition='fft', seed=seed)
+                yield s
+            return
+
+        if propagate:
+            yield from self.iter_propagate(log=log, seed=seed, bidirectional=bidirectional, cache=cache, **parameters)
+            return
+
+        if not workers:
+            initials = self.estimate_translations(log=log) if engine == 'fft+mi' else [None] * len(self.volume)
+            for s, initial in zip(self.volume.slices, initials):
+                s.registration.calculate_transformation(log=log, seed=seed, initial=initial, cache=cache, **parameters)
+                yield s
+            return
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_registration_worker) as pool:
+            futures = self.submit(pool, log=log, seed=seed, engine=engine, cache=cache, **parameters)
+            submitted = set(futures.values())
+            yield from (s for s in self.volume.slices if s not in submitted)  # result was found in cache
+            for future in as_completed(futures):
+                s = futures[future]
+                s.registration.set_result(*future.result(), seed=seed)
+                s.registration.save_cached(cache)
+                yield s
+
+    def iter_propagate(self, log=False, seed=None, bidirectional=False, cache=None, **parameters):
+        """Register slices in order, starting each from the previous slice's translation, then if bidirectional in
+        reverse order, starting each from the next slice's translation"""
+        passes = [self.volume.slices, self.volume.slices[::-1]] if bidirectional else [self.volume.slices]
+        for i, slices in enumerate(passes):
+            initial = None
+            for s in slices:
+                s.registration.calculate_transformation(log=log, seed=seed, initial=initial, keep_better=i > 0,
+                                                        cache=cache, **parameters)
+                initial = s.registration.transformation.GetParameters()
+                yield s
+
+    def submit(self, pool, log=False, seed=None, engine='mi', cache=None, **parameters):
+        """Submit registration of each slice to pool, returning dict of future: slice. With the 'fft+mi' engine each
+        registration starts from the phase correlation estimate. Slices with a result in cache are set straight away
+        instead of being submitted"""
+        initials = self.estimate_translations(log=log) if engine == 'fft+mi' else [None] * len(self.volume)
+        return {pool.submit(register_slice, s.registration.fixed_data(), s.registration.moving_data(), log, seed,
+                            initial=initial, **parameters): s for s, initial in zip(self.volume.slices, initials)
+                if not s.registration.load_cached(cache, log=log, seed=seed, initial=initial, **parameters)}
+
+    def estimate_translations(self, log=False):
+        """Estimate translation (x, y) in mm of every slice to its reference slice at once by phase correlation"""
+        fixed, moving = self.reference_volume.slices, self.volume.slices
+        with self.reference_volume.pinned(), self.volume.pinned():
+            fixed_arrays, moving_arrays = [s.array for s in fixed], [s.array for s in moving]
+        if any(f.spacing != m.spacing or a.shape != b.shape
+               for f, m, a, b in zip(fixed, moving, fixed_arrays, moving_arrays)):
+            raise ValueError("Phase correlation needs slices with the same size and spacing as their reference slice")
+
+        shifts = phase_correlation(np.stack(fixed_arrays), np.stack(moving_arrays), log=log)
+        spacing = np.array([s.spacing for s in moving])
+        origin_offsets = np.array([m.origin for m in moving]) - np.array([f.origin for f in fixed])
+        return shifts * spacing + origin_offsets
 
     def get(self):
         """Update Volume Slice Translation Object with Slice Translation Registration Transform (x,y) parameters"""
@@ -58,46 +180,230 @@ class VolumeSliceTranslation:
         for s, x, y in zip(self.volume.slices, self.x, self.y):
             s.registration.transformation.SetParameters([x, y])
 
-    def smooth(self, *, k_x=15, k_y=15, st_x=98, st_y=98, msl_x=30, msl_y=30):
-        self.get()
-        self.x = fit_steps(self.x, k=k_x, threshold=st_x, min_step_length=msl_x)
-        self.y = fit_steps(self.y, k=k_y, threshold=st_y, min_step_length=msl_y)
+    def reset_translations(self):
+        """Forget the raw translations and smoothing results, once translations have been (re)calculated"""
+        self.raw = None
+        self.smoothed = {}
+
+    def raw_translations(self):
+        """Array (2, slices) of calculated x and y translations, read from the slice transforms once after each
+        calculate. Zeros if not calculated yet"""
+        if self.raw is None:
+            try:
+                self.raw = np.array([s.registration.transformation.GetParameters()
+                                     for s in self.volume.slices]).T.reshape(2, len(self.volume))
+            except AttributeError:
+                return np.zeros((2, len(self.volume)))
+        return self.raw
 
-    def plot(self):
-        fig = plt.figure(figsize=[15, 12])
-        try:
-            x = [s.registration.transformation.GetParameters()[0] for s in self.volume.slices]
-            y = [s.registration.transformation.GetParameters()[1] for s in self.volume.slices]
-        except AttributeError:
-            x = [0] * len(self.volume)
-            y = [0] * len(self.volume)
-        plt.plot(x)
-        plt.plot(y)
-        if self.x and self.y:
-            plt.plot(self.x)
-            plt.plot(self.y)
+    def smooth(self, *, k_x=15, k_y=15, st_x=98, st_y=98, msl_x=30, msl_y=30):
+        # fit_steps results are memoised per axis and parameters, so only an axis whose parameters changed is fitted
+        keys = [(0, k_x, st_x, msl_x), (1, k_y, st_y, msl_y)]
+        missing = [key for key in keys if key not in self.smoothed]
+        if missing:
+            axes, k, threshold, min_step_length = zip(*missing)
+            fitted = fit_steps(self.raw_translations()[list(axes)], k=k, threshold=threshold,
+                               min_step_length=min_step_length)
+            self.smoothed.update(zip(missing, fitted))
+        self.x, self.y = (self.smoothed[key] for key in keys)
+
+    def plot(self, show=True):
+        """Plot calculated and adjusted (smoothed) translations of each slice, keeping the figure and lines so that
+        update_plot can change them in place"""
+        if self.figure is not None:
+            plt.close(self.figure)
+        self.figure = plt.figure(figsize=[15, 12])
+        self.lines = [line for data in self.plot_data() for line in plt.plot(data)]
 
         plt.title(self.volume.name)
         plt.legend(['x', 'y', 'x adjusted', 'y adjusted'])
         plt.xlabel('Slice Index')
         plt.ylabel('Translation (mm)')
-        plt.show()
+        if show:
+            plt.show()
+
+    def update_plot(self):
+        """Update the line data of the last plot in place, rather than drawing a new figure"""
+        if self.figure is None:
+            return self.plot(show=False)
+        for line, data in zip(self.lines, self.plot_data()):
+            line.set_ydata(data)
+        ax = self.figure.axes[0]
+        ax.relim()
+        ax.autoscale_view()
+        self.figure.canvas.draw_idle()
+
+    def plot_data(self):
+        # adjusted lines are empty (nans) until translations have been smoothed
+        adjusted = [self.x, self.y] if len(self.x) and len(self.y) else [np.full(len(self.volume), np.nan)] * 2
+        return [*self.raw_translations(), *adjusted]
 
     def transform(self):
-        if self.x and self.y:
+        if len(self.x) and len(self.y):
             self.set()
-        [s.registration.transform() for s in self.volume.slices]
-
-    def __call__(self, *args, reference, log=True, smooth=False, **kwargs):
-        # use this to set reference volume, calculate, smooth if specified and transform, passing kwargs through
+        for s in self.volume.slices:
+            if s.registration.transformation is None:
+                s.registration.calculate_transformation()
+        if not self.transform_volume():
+            [s.registration.transform() for s in self.volume.slices]
+
+    def transform_volume(self):
+        """Apply the translation of every slice in one vectorised resample of the stacked volume, giving the same
+        result as SliceTranslation.transform. Returns False if the slices can't be stacked (mixed sizes or pixel types
+        other than uint16)"""
+        moving, fixed = self.volume.slices, self.reference_volume.slices
+        with self.volume.pinned(), self.reference_volume.pinned():
+            moving_arrays, fixed_arrays = [s.array for s in moving], [s.array for s in fixed]
+        if len({a.shape for a in moving_arrays}) != 1 or len({a.shape for a in fixed_arrays}) != 1 \
+                or any(a.dtype != np.uint16 for a in moving_arrays):
+            return False
+
+        moved = translate_slices(np.stack(moving_arrays),
+                                 [s.registration.transformation.GetParameters() for s in moving],
+                                 [s.origin for s in moving], [s.spacing for s in moving],
+                                 [s.origin for s in fixed], [s.spacing for s in fixed], fixed_arrays[0].shape)
+        for s, f, array in zip(moving, fixed, moved.astype(np.uint16)):  # truncates as sitk.Cast does
+            s.image = array_to_image(array, f.spacing, f.origin)
+        return True
+
+    def report(self):
+        """Print optimiser iterations and wall time of the last calculate"""
+        print(f'{self.volume.name}: {self.iterations} iterations ({self.iterations / len(self.volume):.1f} per slice), '
+              f'{self.duration:.2f} s ({self.duration / len(self.volume) * 1000:.1f} ms per slice)')
+
+    def telemetry(self):
+        """Structured array (TELEMETRY_DTYPE) of each slice's registration: optimiser iterations, stop condition,
+        final metric value, wall time (s) and whether the result came from the cache. Without a metric trace,
+        iterations are those of the final level only"""
+        return np.array([(s.slice_location, s.registration.iterations, s.registration.stop_condition or '',
+                          np.nan if s.registration.metric_value is None else s.registration.metric_value,
+                          s.registration.duration, s.registration.cached) for s in self.volume.slices],
+                        dtype=TELEMETRY_DTYPE)
+
+    def summary(self, print_results=True):
+        """Summarise the telemetry of the volume, eg. to tune NUM_ITER and MIN_STEP: iteration distribution, how
+        often each stop condition was met, final metric and time taken. Returns the summary as a dict"""
+        telemetry = self.telemetry()
+        iterations = telemetry['iterations']
+        conditions, counts = np.unique(telemetry['stop_condition'], return_counts=True)
+        metric = telemetry['metric'][~np.isnan(telemetry['metric'])]  # no metric for phase correlation estimates
+        summary = dict(volume=self.volume.name, slices=len(telemetry),
+                       iterations_mean=float(iterations.mean()), iterations_median=float(np.median(iterations)),
+                       iterations_95th=float(np.percentile(iterations, 95)), iterations_max=int(iterations.max()),
+                       stop_conditions=dict(zip(conditions.tolist(), counts.tolist())),
+                       metric_mean=float(metric.mean()) if len(metric) else np.nan,
+                       metric_worst=float(metric.max()) if len(metric) else np.nan,
+                       duration=float(telemetry['duration'].sum()), cached=int(telemetry['cached'].sum()))
+        if print_results:
+            print(f'------- {self.volume.name} registration -------')
+            print(f'Iterations: mean = {summary["iterations_mean"]:.1f}, median = {summary["iterations_median"]:.0f}, '
+                  f'95th percentile = {summary["iterations_95th"]:.0f}, max = {summary["iterations_max"]} '
+                  f'(limit {NUM_ITER})')
+            print(f'Stop conditions: {summary["stop_conditions"]}')
+            print(f'Final metric: mean = {summary["metric_mean"]:.4f}, worst = {summary["metric_worst"]:.4f}')
+            print(f'Time: {summary["duration"]:.2f} s ({summary["duration"] / len(telemetry) * 1000:.1f} ms per slice), '
+                  f'{summary["cached"]} slices from cache')
+        return summary
+
+    def compare_calculations(self, baseline, alternative, log=True, seed=0):
+        """Calculate with baseline then alternative (dicts of calculate parameters), printing the iterations and time
+        taken by each and the difference between the translations found. Leaves the baseline result in place"""
+        results = {}
+        for description, parameters in [('alternative', alternative), ('baseline', baseline)]:
+            self.calculate(log=log, seed=seed, use_cache=False, **parameters)
+            results[description] = (self.iterations, self.duration,
+                                    np.array([s.registration.transformation.GetParameters()
+                                              for s in self.volume.slices]))
+
+        for description in ['baseline', 'alternative']:
+            iterations, duration, _ = results[description]
+            print(f'{description} {alternative if description == "alternative" else baseline}: '
+                  f'{iterations} iterations, {duration:.2f} s ({duration / len(self.volume) * 1000:.1f} ms per slice)')
+        print(f'Iterations saved: {results["baseline"][0] - results["alternative"][0]}')
+        difference = np.abs(results['alternative'][2] - results['baseline'][2])
+        print(f'Translation difference (mm) (x,y): mean = {tuple(difference.mean(axis=0).round(3))}, '
+              f'max = {tuple(difference.max(axis=0).round(3))}')
+
+    def compare_multi_resolution(self, log=True, seed=0, shrink_factors=(4, 2, 1), smoothing_sigmas=(2, 1, 0),
+                                 level_iterations=None):
+        """Compare multi-resolution against single-level registration of each slice"""
+        self.compare_calculations({}, dict(shrink_factors=shrink_factors, smoothing_sigmas=smoothing_sigmas,
+                                           level_iterations=level_iterations), log=log, seed=seed)
+
+    def compare_warm_start(self, log=True, seed=0, bidirectional=False):
+        """Compare registration propagated from neighbouring slices against registering each slice from zero"""
+        self.compare_calculations({}, dict(propagate=True, bidirectional=bidirectional), log=log, seed=seed)
+
+    def __call__(self, *args, reference, log=True, smooth=False, workers=None, seed=None, engine='mi',
+                 propagate=False, bidirectional=False, **kwargs):
+        # use this to set reference volume, calculate, smooth if specified and transform, passing kwargs through to
+        # set_registration_parameters (REGISTRATION_PARAMETERS) or smooth
+        parameters = {k: kwargs.pop(k) for k in REGISTRATION_PARAMETERS if k in kwargs}
         self.reference_volume = reference
-        self.calculate(log=log)
+        self.calculate(log=log, workers=workers, seed=seed, engine=engine, propagate=propagate,
+                       bidirectional=bidirectional, **parameters)
+        self.apply(smooth=smooth, **kwargs)
+
+    def apply(self, smooth=False, **kwargs):
+        # smooth if specified, plot and transform calculated translations, passing kwargs to smooth
         if smooth:
             self.smooth(**kwargs)
         self.plot()
         self.transform()
 
 
+def register_concurrently(registrations, reference, smooth=False, log=True, workers=None, seed=None, engine='mi',
+                          **kwargs):
+    """Register the volumes of several VolumeSliceTranslations to the same reference at once, submitting the slices
+    of every volume to one pool of worker processes (workers, default one per CPU) with a combined progress bar.
+    Translations are smoothed if specified, plotted and applied once all volumes are done. kwargs are passed to
+    set_registration_parameters (REGISTRATION_PARAMETERS) or smooth"""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', use one of {ENGINES}")
+    parameters = {k: kwargs.pop(k) for k in REGISTRATION_PARAMETERS if k in kwargs}
+    if 'level_iterations' in parameters:
+        parameters['level_iterations'] = level_iteration_caps(parameters['level_iterations'],
+                                                              parameters.get('shrink_factors'))
+    for registration in registrations:
+        registration.reference_volume = reference
+
+    if engine == 'fft':  # already done for all slices at once, nothing to gain from a pool
+        for registration in registrations:
+            registration.calculate(log=log, seed=seed, engine=engine, **parameters)
+    else:
+        print(f'Calculating translation transforms of {", ".join(r.volume.name for r in registrations)} '
+              f'to {reference.name}')
+        time.sleep(.3)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_registration_worker) as pool:
+            futures, done = {}, {}
+            for registration in registrations:
+                registration.iterations = 0
+                submitted = registration.submit(pool, log=log, seed=seed, engine=engine, cache=registration.cache,
+                                                **parameters)
+                futures.update({future: (registration, s) for future, s in submitted.items()})
+                done[registration] = len(registration.volume) - len(submitted)  # results found in cache
+
+            with tqdm(total=sum(len(r.volume) for r in registrations), initial=sum(done.values())) as pbar:
+                for future in as_completed(futures):
+                    registration, s = futures[future]
+                    s.registration.set_result(*future.result(), seed=seed)
+                    s.registration.save_cached(registration.cache)
+                    registration.iterations += s.registration.iterations
+                    done[registration] += 1
+                    pbar.set_postfix({r.volume.name: f'{n}/{len(r.volume)}' for r, n in done.items()}, refresh=True)
+                    pbar.update()
+
+        for registration in registrations:
+            registration.duration = time.perf_counter() - start  # wall time of the shared run
+            registration.reset_translations()
+            if registration.cache is not None:
+                registration.cache.commit()
+
+    for registration in registrations:
+        registration.apply(smooth=smooth, **kwargs)
+
+
 class SliceTranslation:
     def __init__(self, parent_slice):
         self._moving = parent_slice
@@ -106,6 +412,18 @@ class SliceTranslation:
         self.resampling_filter = None
         self.transformation = None
         self.metric = []
+        self.metric_value = None  # final metric value
+        self.iterations = 0  # optimiser iterations and wall time (s) of the last registration
+        self.duration = 0
+        self.stop_condition = None  # short name of why the optimiser stopped, see STOP_CONDITIONS
+        self.cached = False  # result was taken from the RegistrationCache
+        self.cache_key = None  # content key of the current result in the RegistrationCache
+        self.trace = False
+        self.level_iterations = None
+        self.plateau = None
+        self._iterations = 0
+        self._level_metric = []
+        self._stopped_by = None
 
     @property
     def fixed(self):
@@ -118,27 +436,128 @@ class SliceTranslation:
                              f"moving = {self._moving.slice_location}")
         self._fixed = f
 
-    def calculate_transformation(self, log=False):
-        self.set_registration_parameters()
-        moving = sitk.Cast(self._moving.image, sitk.sitkFloat32)
-        fixed = sitk.Cast(self._fixed.image, sitk.sitkFloat32)
-        moving = self.get_log_image(moving) if log else moving
-        fixed = self.get_log_image(fixed) if log else fixed
-        self.transformation = self.registration_method.Execute(fixed, moving)
-
-    def set_registration_parameters(self):
-        num_bins, sampling_percentage, sampling_seed = 50, 0.5, sitk.sitkWallClock
-        learning_rate, min_step, num_iter = 1.0, .001, 200
+    def calculate_transformation(self, log=False, seed=None, initial=None, keep_better=False, cache=None,
+                                 **parameters):
+        """Register moving slice to fixed slice, starting from initial translation (x, y) if given. If keep_better is
+        set, the previous result is kept when it has a better final metric value. If a RegistrationCache is given,
+        the result is looked up in it, or stored in it once calculated"""
+        previous = self.result_state()
+        self.metric = []
+        start = time.perf_counter()
+        calculated = not self.load_cached(cache, log=log, seed=seed, initial=initial, **parameters)
+        key = self.cache_key
+        if calculated:
+            self.set_registration_parameters(seed=seed, initial=initial, **parameters)
+            moving = self._moving.registration_image(log)
+            fixed = self._fixed.registration_image(log)
+            self.transformation = self.registration_method.Execute(fixed, moving)
+            self.record_result()
+        self.duration = time.perf_counter() - start
+
+        if keep_better and previous['transformation'] is not None and previous['metric_value'] is not None \
+                and previous['metric_value'] <= self.metric_value:
+            self.set_result_state(previous)
+        if calculated:
+            # stored under this registration's key, so a cached rerun gives the result that was kept
+            self.save_cached(cache, key)
+
+    def result_state(self):
+        """All fields of the current result, to restore with set_result_state"""
+        return {field: getattr(self, field) for field in RESULT_FIELDS}
+
+    def set_result_state(self, state):
+        for field, value in state.items():
+            setattr(self, field, value)
+
+    def set_result(self, parameters, metric, metric_value=None, duration=0, iterations=None, stop_condition=None,
+                   seed=None):
+        """Set transformation calculated elsewhere, eg. by register_slice in a worker process"""
+        self.set_registration_parameters(seed=seed)
+        self.transformation = sitk.TranslationTransform(2, tuple(float(p) for p in parameters))
+        self.metric = list(metric)
+        self.metric_value = metric_value
+        self.iterations = len(self.metric) if iterations is None else iterations
+        self.stop_condition = stop_condition
+        self.duration = duration
+        self.cached = False
+
+    def record_result(self):
+        """Record final metric value, iterations and stop condition once registration has been executed"""
+        self.metric_value = self.registration_method.GetMetricValue()
+        # iterations are counted by on_iteration if it was used, otherwise the optimiser only has the final level's
+        self.iterations = self._iterations if self.callbacks else self.registration_method.GetOptimizerIteration()
+        description = self.registration_method.GetOptimizerStopConditionDescription()
+        self.stop_condition = self._stopped_by or next(
+            (condition for text, condition in STOP_CONDITIONS.items() if text in description), 'other')
+
+    def registration_key(self, log=False, seed=None, initial=None, **parameters):
+        """Content key of this registration: fixed and moving pixel data and geometry, and all parameters"""
+        initial = None if initial is None else tuple(float(t) for t in initial)
+        return content_key(np.asarray(self._fixed.array), self._fixed.spacing, self._fixed.origin,
+                           np.asarray(self._moving.array), self._moving.spacing, self._moving.origin,
+                           log, seed, initial, sorted(parameters.items()), REGISTRATION_SETTINGS)
+
+    def load_cached(self, cache, log=False, seed=None, **parameters):
+        """Set result from cache if this registration has been run before, returning True if it was found"""
+        self.cache_key, self.cached = None, False
+        if cache is None:
+            return False
+        self.cache_key = self.registration_key(log=log, seed=seed, **parameters)
+        result = cache.lookup(self.cache_key)
+        if result is None:
+            return False
+        parameters, metric, metric_value, iterations, stop_condition = result
+        self.set_result(parameters, metric, metric_value, iterations=iterations, stop_condition=stop_condition,
+                        seed=seed)
+        self.cached = True
+        return True
+
+    def save_cached(self, cache, key=None):
+        key = self.cache_key if key is None else key
+        if cache is not None and key is not None:
+            cache.update(key, self.transformation.GetParameters(), self.metric, self.metric_value,
+                         self.iterations, self.stop_condition)
+
+    def fixed_data(self):
+        return np.array(self._fixed.array), self._fixed.spacing, self._fixed.origin
+
+    def moving_data(self):
+        return np.array(self._moving.array), self._moving.spacing, self._moving.origin
+
+    def set_registration_parameters(self, seed=None, shrink_factors=None, smoothing_sigmas=None,
+                                    level_iterations=None, initial=None, trace=False, plateau_window=None,
+                                    plateau_tolerance=1e-4):
+        """Set up registration, multi-resolution if shrink_factors (and smoothing_sigmas in mm) are given per level,
+        coarsest first. level_iterations caps the number of optimiser iterations at each level (an int caps every
+        level). initial is the translation (x, y) to start optimising from. If trace is set, the metric of each
+        iteration is recorded, eg. for plot_metric. If plateau_window is set, optimisation (of each level) stops
+        early once the best metric has improved by less than plateau_tolerance over that many iterations. The
+        iteration observer these need is only added when one of them is set"""
+        level_iterations = level_iteration_caps(level_iterations, shrink_factors)
+        sampling_seed = sitk.sitkWallClock if seed is None else seed
 
         self.registration_method = sitk.ImageRegistrationMethod()
-        self.registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
-        self.registration_method.SetMetricSamplingPercentage(sampling_percentage, sampling_seed)
+        self.registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=NUM_BINS)
+        self.registration_method.SetMetricSamplingPercentage(SAMPLING_PERCENTAGE, sampling_seed)
         self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-        self.registration_method.SetOptimizerAsRegularStepGradientDescent(learning_rate, min_step, num_iter)
-        self.registration_method.SetInitialTransform(sitk.TranslationTransform(2))
+        self.registration_method.SetOptimizerAsRegularStepGradientDescent(LEARNING_RATE, MIN_STEP, NUM_ITER)
+        initial = (0, 0) if initial is None else tuple(float(t) for t in initial)
+        self.registration_method.SetInitialTransform(sitk.TranslationTransform(2, initial))
         self.registration_method.SetInterpolator(sitk.sitkLinear)
         self.registration_method.SetOptimizerScalesFromPhysicalShift()
-        self.registration_method.AddCommand(sitk.sitkIterationEvent, lambda: self.record_metric())
+
+        if shrink_factors:
+            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=list(shrink_factors))
+            self.registration_method.SetSmoothingSigmasPerLevel(
+                smoothingSigmas=list(smoothing_sigmas) if smoothing_sigmas else [0] * len(shrink_factors))
+            self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+
+        self.trace, self.level_iterations = trace, level_iterations
+        self.plateau = (plateau_window, plateau_tolerance) if plateau_window else None
+        self._iterations, self._level_metric, self._stopped_by = 0, [], None
+        if self.callbacks:  # a Python callback every iteration has a cost, so only add it when needed
+            self.registration_method.AddCommand(sitk.sitkIterationEvent, lambda: self.on_iteration())
+            self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, lambda: self.start_level())
 
         self.resampling_filter = sitk.ResampleImageFilter()
         self.resampling_filter.SetInterpolator(sitk.sitkLinear)
@@ -154,64 +573,268 @@ class SliceTranslation:
         if self.transformation is None:
             self.calculate_transformation()
 
-        moving = sitk.Cast(self._moving.image, sitk.sitkFloat32)
-        fixed = sitk.Cast(self._fixed.image, sitk.sitkFloat32)
+        moving = self._moving.registration_image()
+        fixed = self._fixed.registration_image()
 
         self.resampling_filter.SetReferenceImage(fixed)
         self.resampling_filter.SetTransform(self.transformation)
         self._moving.image = sitk.Cast(self.resampling_filter.Execute(moving), self._moving.image.GetPixelID())
 
-    def record_metric(self):
-        self.metric.append(self.registration_method.GetMetricValue())
+    @property
+    def callbacks(self):
+        return bool(self.trace or self.level_iterations or self.plateau)
+
+    def start_level(self):
+        self._level_metric, self._stopped_by = [], None
+
+    def on_iteration(self):
+        # StopRegistration only ends optimisation at the current level, registration moves on to the next level
+        value = self.registration_method.GetMetricValue()
+        self._iterations += 1
+        self._level_metric.append(value)
+        if self.trace:
+            self.metric.append(value)
+
+        if self.level_iterations and \
+                len(self._level_metric) >= self.level_iterations[self.registration_method.GetCurrentLevel()]:
+            self._stopped_by = 'level_iterations'
+            self.registration_method.StopRegistration()
+        elif self.plateau and self.is_plateau():
+            self._stopped_by = 'plateau'
+            self.registration_method.StopRegistration()
+
+    def is_plateau(self):
+        """True if the best metric of the level has improved by less than the plateau tolerance over the window"""
+        window, tolerance = self.plateau
+        if len(self._level_metric) <= window:
+            return False
+        return min(self._level_metric[:-window]) - min(self._level_metric[-window:]) < tolerance
 
     def plot_metric(self):
         # todo: should in theory have some way of preventing plotting if registration hasn't happened
+        if not self.metric:
+            print('No metric trace recorded, calculate the registration with trace=True to plot it')
+            return
         plt.plot(self.metric)
         plt.xlabel('Iteration Number')
         plt.ylabel('(-ve) Mutual Information')
         plt.show()
 
+    @staticmethod
+    def prepare_image(image, log=False):
+        """Cast image to float32 for registration, taking the log if specified"""
+        image = sitk.Cast(image, sitk.sitkFloat32)
+        return SliceTranslation.get_log_image(image) if log else image
+
     @staticmethod
     def get_log_image(image):
         """Get Log of image, with zero value pixels set to one"""
         image = sitk.Add(image, sitk.Cast(image == 0, sitk.sitkFloat32))  # replace zeros with ones
         return sitk.Log(image)
 
-    # todo: consider:
-    # Setup for the multi-resolution framework:
-    # self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[10, 2, 1])
-    # self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
-    # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-
-def register_station(fixed, moving):
-    num_bins, sampling_percentage, sampling_seed = 50, 0.5, sitk.sitkWallClock
-    learning_rate, min_step, num_iter = 1.0, .001, 200
 
+def level_iteration_caps(level_iterations, shrink_factors=None):
+    """Iteration cap of each registration level: an int caps every level, a sequence needs one cap per shrink factor
+    (a single level without shrink_factors). None if level_iterations is None"""
+    if level_iterations is None:
+        return None
+    levels = len(shrink_factors) if shrink_factors else 1
+    if isinstance(level_iterations, int):
+        return (level_iterations,) * levels
+    level_iterations = tuple(level_iterations)
+    if len(level_iterations) != levels:
+        raise ValueError(f"level_iterations has {len(level_iterations)} values for {levels} registration levels, "
+                         f"give one per shrink factor or a single int")
+    return level_iterations
+
+
+def init_registration_worker():
+    # each worker process registers one slice at a time, so don't oversubscribe cores with ITK threads
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+
+
+def register_slice(fixed, moving, log=False, seed=None, **parameters):
+    """Register moving slice to fixed slice, each given as (pixel array, spacing, origin). Runs in worker processes,
+    returning the translation parameters, the metric value of each iteration, the final metric value, the time
+    taken, the number of iterations and the stop condition"""
+    start = time.perf_counter()
+    registration = SliceTranslation(parent_slice=None)
+    registration.set_registration_parameters(seed=seed, **parameters)
+    fixed, moving = (registration.prepare_image(array_to_image(*data), log) for data in (fixed, moving))
+    transformation = registration.registration_method.Execute(fixed, moving)
+    registration.record_result()
+    return (transformation.GetParameters(), registration.metric, registration.metric_value,
+            time.perf_counter() - start, registration.iterations, registration.stop_condition)
+
+
+def array_to_image(array, spacing, origin):
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    return image
+
+
+def phase_correlation(fixed, moving, log=False, bandwidth=0.07, iterations=3, batch_size=32):
+    """Estimate the shift (x, y) in pixels of each moving slice from its fixed slice, given as arrays of shape
+    (slices, rows, cols), by phase correlation with sub-pixel refinement of the correlation peak.
+    bandwidth (cycles per pixel) is the sigma of the gaussian weighting of the normalised cross-power spectrum, which
+    stops the noise dominated high frequencies of smooth images swamping the peak, and makes the peak gaussian so
+    that it is refined by a parabola through the log of the peak and its neighbours.
+    A window fixed on both slices pulls the peak towards zero shift, so the estimate is repeated iterations times with
+    hann windows over the region the slices overlap at the last estimate, which follow the image content"""
+    rows, cols = fixed.shape[1:]
+    frequencies = np.fft.fftfreq(rows)[:, None] ** 2 + np.fft.rfftfreq(cols)[None] ** 2
+    weights = np.exp(-frequencies / (2 * bandwidth ** 2)).astype(np.float32)
+    shifts = np.zeros((len(fixed), 2))
+    for start in range(0, len(fixed), batch_size):  # bound memory used by the spectra
+        f, m = (np.asarray(a[start:start + batch_size], dtype=np.float32) for a in (fixed, moving))
+        if log:
+            f, m = (np.log(np.where(a == 0, 1, a)) for a in (f, m))  # as get_log_image
+        f, m = (a - a.mean(axis=(1, 2), keepdims=True) for a in (f, m))
+        for _ in range(iterations):
+            fixed_window, moving_window = overlap_windows(shifts[start:start + len(f)], rows, cols)
+            cross_power = np.fft.rfft2(m * moving_window) * np.conj(np.fft.rfft2(f * fixed_window))
+            cross_power *= weights / np.maximum(np.abs(cross_power), np.finfo(np.float32).tiny)
+            shifts[start:start + len(f)] = correlation_peak(np.fft.irfft2(cross_power, s=(rows, cols)))
+    return shifts
+
+
+def overlap_windows(shifts, rows, cols):
+    """Hann windows (slices, rows, cols) of the fixed and moving slices over the region where they overlap when the
+    moving slice is shifted by (x, y) pixels, so that the windowed moving slice is the windowed fixed slice shifted"""
+    windows = []
+    for size, shift in [(rows, shifts[:, 1, None]), (cols, shifts[:, 0, None])]:
+        length = np.maximum(size - 1 - np.abs(shift), 1)
+        fixed_start = np.maximum(-shift, 0)
+        windows.append([hann(np.arange(size) - start, length) for start in (fixed_start, fixed_start + shift)])
+    (fixed_rows, moving_rows), (fixed_cols, moving_cols) = windows
+    return ((fixed_rows[:, :, None] * fixed_cols[:, None, :]).astype(np.float32),
+            (moving_rows[:, :, None] * moving_cols[:, None, :]).astype(np.float32))
+
+
+def hann(x, length):
+    """Hann window over 0 <= x <= length, zero outside"""
+    t = x / length
+    return np.where((t >= 0) & (t <= 1), 0.5 - 0.5 * np.cos(2 * np.pi * t), 0)
+
+
+def correlation_peak(correlation):
+    """Position (x, y) of the peak of each circular correlation (slices, rows, cols), between -size/2 and size/2,
+    refined by a parabola through the log of the peak and its neighbours along each axis (exact for a gaussian peak),
+    or through the values themselves where a neighbour isn't positive"""
+    n, rows, cols = correlation.shape
+    idx = np.arange(n)
+    peak_row, peak_col = np.unravel_index(correlation.reshape(n, -1).argmax(axis=1), (rows, cols))
+    centre = correlation[idx, peak_row, peak_col]
+    shifts = np.zeros((n, 2))
+    for axis, (peak, size) in enumerate([(peak_col, cols), (peak_row, rows)]):
+        # neighbours of the peak either side along this axis, wrapping around as the correlation is circular
+        before, after = ((idx, peak_row, (peak_col + d) % cols) if axis == 0
+                         else (idx, (peak_row + d) % rows, peak_col) for d in (-1, 1))
+        values = np.stack([correlation[before], centre, correlation[after]]).astype(float)
+        positive = (values > 0).all(axis=0)
+        before, centre_value, after = np.where(positive, np.log(np.where(positive, values, 1)), values)
+        denominator = before - 2 * centre_value + after
+        offset = np.where(denominator < 0, 0.5 * (before - after) / np.where(denominator < 0, denominator, -1), 0)
+        shift = peak + np.clip(offset, -0.5, 0.5)
+        shifts[:, axis] = np.where(shift > size / 2, shift - size, shift)
+    return shifts
+
+
+def translate_slices(moving, translations, moving_origins, moving_spacings, fixed_origins, fixed_spacings, shape,
+                     batch_size=32):
+    """Resample each moving slice of array (slices, rows, cols) onto its fixed slice's grid (origin, spacing and
+    shape (rows, cols)) under translation (x, y) in mm, in one vectorised pass. Matches ResampleImageFilter with
+    linear interpolation and a default pixel value of 0 on float32 images: points up to half a pixel outside the
+    moving slice are inside, with neighbours past the edge clamped to it. Returns a float32 array"""
+    translations, moving_origins, moving_spacings, fixed_origins, fixed_spacings = (
+        np.asarray(a, dtype=float) for a in (translations, moving_origins, moving_spacings, fixed_origins,
+                                            fixed_spacings))
+    moved = np.zeros((len(moving), *shape), dtype=np.float32)
+    for start in range(0, len(moving), batch_size):
+        batch = slice(start, start + batch_size)
+        m = np.asarray(moving[batch], dtype=np.float32)
+        idx = np.arange(len(m))[:, None, None]
+
+        # continuous index of each output column (x) and row (y) in moving slice, in the same order as ITK
+        # (physical point of fixed index, translated, then to moving index), the translation is separable in x and y
+        corners, limits = [], []
+        for axis, size in enumerate(shape[::-1]):
+            point = fixed_origins[batch, axis, None] + fixed_spacings[batch, axis, None] * np.arange(size)
+            c = (point + translations[batch, axis, None] - moving_origins[batch, axis, None]) \
+                * (1 / moving_spacings[batch, axis, None])
+            last = m.shape[2 - axis] - 1
+            inside = (c >= -0.5) & (c < last + 0.5)
+            base = np.maximum(np.floor(c), 0)
+            distance = np.maximum(c - base, 0)
+            base = np.minimum(base, last).astype(np.intp)
+            corners.append((base, np.minimum(base + 1, last), distance))
+            limits.append(inside)
+
+        (x0, x1, dx), (y0, y1, dy) = corners
+        x0, x1, dx = x0[:, None, :], x1[:, None, :], dx[:, None, :]
+        y0, y1, dy = y0[:, :, None], y1[:, :, None], dy[:, :, None]
+        v00, v10, v01, v11 = (m[idx, y, x].astype(float) for y, x in [(y0, x0), (y0, x1), (y1, x0), (y1, x1)])
+        vx0 = v00 + (v10 - v00) * dx
+        vx1 = v01 + (v11 - v01) * dx
+        values = vx0 + (vx1 - vx0) * dy
+        inside = limits[1][:, :, None] & limits[0][:, None, :]
+        moved[batch] = np.where(inside, values, 0)
+    return moved
+
+
+def station_key(fixed, moving, shrink_factors=None, smoothing_sigmas=None):
+    """Content key of a station registration: fixed and moving pixel data and geometry, and the resolution schedule
+    if there is one (so single resolution results keep their key)"""
+    schedule = ()
+    if shrink_factors:
+        schedule = (tuple(shrink_factors),
+                    tuple(smoothing_sigmas) if smoothing_sigmas else (0,) * len(shrink_factors))
+    return content_key('station', REGISTRATION_SETTINGS, *schedule,
+                       sitk.GetArrayViewFromImage(fixed), fixed.GetSpacing(), fixed.GetOrigin(), fixed.GetDirection(),
+                       sitk.GetArrayViewFromImage(moving), moving.GetSpacing(), moving.GetOrigin(),
+                       moving.GetDirection())
+
+
+def calculate_station_translation(fixed, moving, shrink_factors=None, smoothing_sigmas=None, threads=None):
+    """Register float moving station to fixed station, returning the translation parameters, the final metric value,
+    the number of iterations (over all levels) and the time taken. ITK releases the GIL while registering, so
+    stations can be registered in threads, each limited to threads ITK threads so they don't oversubscribe cores"""
+    start = time.perf_counter()
     registration_method = sitk.ImageRegistrationMethod()
-    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
-    registration_method.SetMetricSamplingPercentage(sampling_percentage, sampling_seed)
+    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=NUM_BINS)
+    registration_method.SetMetricSamplingPercentage(SAMPLING_PERCENTAGE, sitk.sitkWallClock)
     registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
-    registration_method.SetOptimizerAsRegularStepGradientDescent(learning_rate, min_step, num_iter)
+    registration_method.SetOptimizerAsRegularStepGradientDescent(LEARNING_RATE, MIN_STEP, NUM_ITER)
     registration_method.SetInitialTransform(sitk.TranslationTransform(3))
     registration_method.SetInterpolator(sitk.sitkLinear)
     registration_method.SetOptimizerScalesFromPhysicalShift()
 
-    resampling_filter = sitk.ResampleImageFilter()
-    resampling_filter.SetInterpolator(sitk.sitkLinear)
-    resampling_filter.SetDefaultPixelValue(0)
-
-    moving = sitk.Cast(moving, sitk.sitkFloat32)
-    fixed = sitk.Cast(fixed, sitk.sitkFloat32)
+    if shrink_factors:
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=list(shrink_factors))
+        registration_method.SetSmoothingSigmasPerLevel(
+            smoothingSigmas=list(smoothing_sigmas) if smoothing_sigmas else [0] * len(shrink_factors))
+        registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+        # GetOptimizerIteration only counts the iterations of the last level, so count those of every level
+        iterations = [0]
+        registration_method.AddCommand(sitk.sitkIterationEvent, lambda: iterations.__setitem__(0, iterations[0] + 1))
+    if threads:
+        registration_method.SetNumberOfThreads(threads)
 
     transformation = registration_method.Execute(fixed, moving)
+    iterations = iterations[0] if shrink_factors else registration_method.GetOptimizerIteration()
+    return (transformation.GetParameters(), registration_method.GetMetricValue(), iterations,
+            time.perf_counter() - start)
 
+
+def move_station(fixed, moving, parameters):
+    """Resample moving station onto fixed station translated by parameters (x, y, z) in mm, as uint16"""
+    resampling_filter = sitk.ResampleImageFilter()
+    resampling_filter.SetInterpolator(sitk.sitkLinear)
+    resampling_filter.SetDefaultPixelValue(0)
     resampling_filter.SetReferenceImage(fixed)
-    resampling_filter.SetTransform(transformation)
+    resampling_filter.SetTransform(sitk.TranslationTransform(3, parameters))
     moved = resampling_filter.Execute(moving)
-    round_tuple = lambda t, n=2: tuple(round(e, n) for e in t)
-    translation = round_tuple(transformation.GetParameters())
-    print(f'Translation (mm) (x,y,z) = {translation}')
     return sitk.Cast(moved, sitk.sitkUInt16)
 
 
@@ -0,0 +1,49 @@
+import tempfile
+import numpy as np
+import SimpleITK as sitk
+
+
+class SliceArray:
+    """Contiguous uint16 pixel array of shape (slices, rows, cols) owned by a volume, with the in-plane spacing and
+    per-slice origins. Array-backed slices hold an index into this array rather than their own image"""
+
+    def __init__(self, array, origins, spacing, memmap=False):
+        if memmap:  # keep pixel data on disk, paged in as needed
+            self.array = np.memmap(tempfile.TemporaryFile(), dtype=np.uint16, mode='w+', shape=array.shape)
+            self.array[:] = array
+        else:
+            self.array = np.ascontiguousarray(array, dtype=np.uint16)
+        self.origins = np.array(origins, dtype=float)
+        self.spacing = tuple(spacing)
+
+    def get_origin(self, i):
+        return tuple(self.origins[i].tolist())
+
+    def get_image(self, i):
+        """Build a 2D image of slice i, the only pixel copy made when accessing an array-backed slice's image"""
+        image = sitk.GetImageFromArray(self.array[i])
+        image.SetSpacing(self.spacing)
+        image.SetOrigin(self.get_origin(i))
+        return image
+
+    def set_image(self, i, image):
+        """Write image back into the array, returning False if it doesn't fit the array's shape, type or spacing"""
+        if image.GetSize() != self.array.shape[:0:-1] or image.GetPixelID() != sitk.sitkUInt16 \
+                or image.GetSpacing() != self.spacing:
+            return False
+        self.array[i] = sitk.GetArrayViewFromImage(image)
+        self.origins[i] = image.GetOrigin()
+        return True
+
+    def stack(self, indices):
+        """Array of the slices at indices, a view (no copy) when they are consecutive in the array"""
+        indices = np.asarray(indices)
+        if len(indices) > 1 and (np.all(np.diff(indices) == 1) or np.all(np.diff(indices) == -1)):
+            step = indices[1] - indices[0]
+            stop = indices[-1] + step if indices[-1] + step >= 0 else None
+            return self.array[indices[0]:stop:step]
+        return self.array[indices]
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class SliceGeometry:
+    """Vectorised geometry of a volume's slices, computed in one pass over slice locations sorted in descending
+    order. Locations (and intervals) closer than tolerance (mm) are treated as equal"""
+
+    def __init__(self, locations, slice_thickness, tolerance=0.005):
+        self.locations = np.asarray(locations, dtype=float)
+        self.slice_thickness = slice_thickness
+        self.tolerance = tolerance
+
+        # interval i is the distance between slice i and slice i + 1:
+        self.intervals = np.abs(np.diff(self.locations))
+        # slices i and i + 1 are duplicated for each i in duplicates:
+        self.duplicates = np.flatnonzero(self.intervals <= tolerance)
+
+        # run length groups of consecutive contiguous intervals, run j covers slices starts[j] to ends[j]:
+        contiguous = np.abs(self.intervals - slice_thickness) <= tolerance
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], contiguous.astype(np.int8), [0]])))
+        self.run_starts, self.run_ends = edges[::2], edges[1::2]
+
+        # sorted copy of locations for location lookups:
+        self._sorted_locations = np.sort(self.locations)
+
+    def largest_contiguous_block(self):
+        """Start and end slice index of the largest block of contiguous slices, the first if there are several"""
+        if not len(self.run_starts):
+            raise ValueError('No contiguous slices found!')
+        largest = np.argmax(self.run_ends - self.run_starts)
+        return int(self.run_starts[largest]), int(self.run_ends[largest])
+
+    def on_grid(self, grid_location):
+        """Boolean mask of slices that lie on the contiguous grid through grid_location"""
+        remainder = np.mod(self.locations - grid_location, self.slice_thickness)
+        return np.minimum(remainder, self.slice_thickness - remainder) <= self.tolerance
+
+    def has_location(self, locations):
+        """Boolean mask of locations that match an existing slice location"""
+        locations = np.asarray(locations, dtype=float)
+        idx = np.searchsorted(self._sorted_locations, locations)
+        below = self._sorted_locations[np.clip(idx - 1, 0, len(self._sorted_locations) - 1)]
+        above = self._sorted_locations[np.clip(idx, 0, len(self._sorted_locations) - 1)]
+        distance = np.minimum(np.abs(locations - below), np.abs(locations - above))
+        return distance <= self.tolerance
+
+    def missing_grid_locations(self, start_location, end_location):
+        """Locations of the contiguous grid extending out from the block between start_location and end_location to
+        either end of the volume, that have no slice yet"""
+        grid = np.concatenate([np.arange(start_location + self.slice_thickness, self.locations[0],
+                                         self.slice_thickness),
+                               np.arange(end_location - self.slice_thickness, self.locations[-1],
+                                         -self.slice_thickness)])
+        return grid[~self.has_location(grid)]
+
+
+class StationIndex:
+    """Lookup table of the slices of a multi-station (coronal) volume, by slice location (rows, in descending order)
+    and station (columns, in descending order of z origin), built in one pass over the slices in any order. Station
+    origins and slice locations closer than tolerance (mm) are treated as equal. Entries without a slice are -1"""
+
+    def __init__(self, station_origins, locations, tolerance=0.005):
+        self.tolerance = tolerance
+        self.stations, station_ids = self.group(station_origins, tolerance)
+        self.locations, location_ids = self.group(locations, tolerance)
+
+        # index of the first slice at each location and station, so duplicates resolve the same way every time:
+        num_slices = len(station_ids)
+        table = np.full((len(self.locations), len(self.stations)), num_slices)
+        np.minimum.at(table, (location_ids, station_ids), np.arange(num_slices))
+        self.table = np.where(table == num_slices, -1, table)
+        counts = np.zeros(table.shape, dtype=int)
+        np.add.at(counts, (location_ids, station_ids), 1)
+        self.duplicates = int(np.maximum(counts - 1, 0).sum())
+
+        # locations with a slice from every station:
+        self.complete = (self.table >= 0).all(axis=1)
+
+    @staticmethod
+    def group(values, tolerance):
+        """Group values closer than tolerance, returning the largest value of each group in descending order and
+        the group id of each value"""
+        values = np.asarray(values, dtype=float)
+        order = np.argsort(-values, kind='stable')
+        starts = np.concatenate([[True], -np.diff(values[order]) > tolerance])
+        ids = np.empty(len(values), dtype=np.intp)
+        ids[order] = np.cumsum(starts) - 1
+        return values[order][starts], ids
+
+    def missing(self):
+        """(slice location, station z origin) of each entry without a slice"""
+        rows, cols = np.nonzero(self.table < 0)
+        return list(zip(self.locations[rows].tolist(), self.stations[cols].tolist()))
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+import SimpleITK as sitk
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_adc_series(folder, sizes, seed=0, locations=None):
+    """Write a synthetic axial ADC series, one DICOM file per slice with matrix sizes (rows, cols) at slice locations
+    (default 5 mm apart), returning the pixel array of each slice in slice order"""
+    os.makedirs(folder, exist_ok=True)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    rng = np.random.default_rng(seed)
+    arrays = []
+    locations = [5.0 * i for i in range(len(sizes))] if locations is None else locations
+    for i, (rows, cols) in enumerate(sizes):
+        array = rng.integers(0, 1000, (1, rows, cols)).astype(np.uint16)
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing((1.0, 1.2, 5.0))
+        for tag, value in [('0008|0060', 'MR'), ('0008|0008', 'ORIGINAL\\PRIMARY\\DIFFUSION\\ADC'),
+                           ('0008|1090', 'Avanto'), ('0018|0024', 'ep_b0'), ('0018|0050', '5'),
+                           ('0020|000d', '1.2.3'), ('0020|000e', '1.2.3.4'), ('0020|0013', str(i + 1)),
+                           ('0020|0032', f'-10\\-20\\{locations[i]}'), ('0020|0037', '1\\0\\0\\0\\1\\0')]:
+            image.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(folder, f'{i:03d}.dcm'))
+        writer.Execute(image)
+        arrays.append(array[0])
+    return arrays
+
+
+@pytest.fixture
+def adc_series(tmp_path):
+    def write(sizes, seed=0, locations=None):
+        folder = str(tmp_path / 'input')
+        return folder, write_adc_series(folder, sizes, seed, locations)
+    return write
@@ -0,0 +1,27 @@
+import itertools
+import numpy as np
+import SimpleITK as sitk
+import pytest
+from coronal_tools import permute_to_axial, resample_to_axial
+
+CORONAL = (1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0)  # direction of coronal volumes, see Volume.compile_volume_from_slices
+
+
+def coronal_volume(size=(12, 9, 5), spacing=(1.5, 2.0, 4.0), origin=(-20.0, 30.0, 100.0)):
+    image = sitk.GetImageFromArray(np.random.default_rng(0).random(size[::-1]).astype(np.float32) * 1000)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.SetDirection(CORONAL)
+    return image
+
+
+@pytest.mark.parametrize('reformat', [permute_to_axial, resample_to_axial])
+def test_corner_voxels_keep_their_physical_points(reformat):
+    coronal = coronal_volume()
+    axial = reformat(coronal)
+    assert axial.GetDirection() == (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+    for corner in itertools.product(*[(0, n - 1) for n in coronal.GetSize()]):
+        point = coronal.TransformIndexToPhysicalPoint(corner)
+        index = np.array(axial.TransformPhysicalPointToContinuousIndex(point))
+        np.testing.assert_allclose(index, np.round(index), atol=1e-6)
+        assert axial[tuple(int(i) for i in np.round(index))] == pytest.approx(coronal[corner], rel=1e-5)
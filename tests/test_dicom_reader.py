@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pytest
+from dicom_reader import read_dcm_series, group_dcm_series, read_dcm_header, HEADER_TAGS
+from volume_correction import VolumeCollection
+
+
+def test_read_dcm_series_needs_one_matrix_size(adc_series):
+    folder, _ = adc_series([(40, 32)] * 3 + [(40, 30)])
+    paths = [f'{folder}/{i:03d}.dcm' for i in range(4)]
+    with pytest.raises(RuntimeError):
+        read_dcm_series(paths)
+    assert group_dcm_series(paths) == [[0, 1, 2], [3]]
+
+
+@pytest.mark.parametrize('storage', ['image', 'array'])
+def test_mixed_size_series_loads(adc_series, storage):
+    folder, arrays = adc_series([(40, 32)] * 4 + [(40, 30)] + [(40, 32)] * 2)
+    collection = VolumeCollection(path=folder, header_index=False, registration_cache=False, storage=storage)
+    volume = collection.volumes['adc']
+    assert volume.slice_array is None
+    # slices are sorted superior to inferior, ie. in reverse of the order written
+    for s, array in zip(volume.slices, arrays[::-1]):
+        assert np.array_equal(s.array, array)
+        assert s.origin[:2] == (-10, -20)
+
+
+def test_uniform_series_is_array_backed(adc_series):
+    folder, arrays = adc_series([(40, 32)] * 5)
+    collection = VolumeCollection(path=folder, header_index=False, registration_cache=False, storage='array')
+    volume = collection.volumes['adc']
+    assert volume.slice_array is not None
+    assert np.array_equal(np.stack([s.array for s in volume.slices]), np.stack(arrays[::-1]))
+
+
+def test_fast_header_matches_full_header(adc_series):
+    folder, _ = adc_series([(40, 32)])
+    path = f'{folder}/000.dcm'
+    _, full, full_name = read_dcm_header(path)
+    _, fast, fast_name = read_dcm_header(path, tags=HEADER_TAGS)
+    assert fast_name == full_name == 'adc'
+    for keyword in ['StudyInstanceUID', 'ImagePositionPatient', 'ImageOrientationPatient', 'SliceThickness',
+                    'ImageType', 'SequenceName', 'ManufacturerModelName']:
+        assert fast[keyword].value == full[keyword].value
+    # reading stops after the last tag needed, so eg. the image pixel description isn't parsed
+    assert 'Rows' in full and 'Rows' not in fast
+
+
+def test_non_dicom_files_are_skipped(adc_series):
+    folder, _ = adc_series([(40, 32)] * 3)
+    with open(os.path.join(folder, 'notes.txt'), 'w') as f:
+        f.write('not a DICOM file')
+    assert read_dcm_header(os.path.join(folder, 'notes.txt'), tags=HEADER_TAGS)[1:] == (None, None)
+    collection = VolumeCollection(path=folder, header_index=False, registration_cache=False)
+    assert len(collection.volumes['adc']) == 3
+
+
+def test_fast_headers_load_the_same_volumes(adc_series):
+    folder, _ = adc_series([(40, 32)] * 4)
+    fast, full = (VolumeCollection(path=folder, fast_headers=fast_headers) for fast_headers in (True, False))
+    assert fast.volumes.keys() == full.volumes.keys()
+    for a, b in zip(fast.volumes['adc'].slices, full.volumes['adc'].slices):
+        assert (a.dcm_path, a.slice_location, a.header_origin) == (b.dcm_path, b.slice_location, b.header_origin)
+        assert np.array_equal(a.array, b.array)
+    # the volume keeps a full header for writing DICOMs either way
+    assert 'Rows' in fast.volumes['adc'].dcm_header
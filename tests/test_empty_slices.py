@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from volume_correction import VolumeCollection
+
+LOCATIONS = [40, 35, 20, 15, 5, 0]  # gaps of two slices (30, 25) and one slice (10)
+
+
+def interpolate_slice_by_slice(locations, arrays, thickness=5):
+    """Missing slices filled one at a time from the slice before (complete or just filled) and the next complete
+    slice, as calculate_empty_slices did before it was batched"""
+    slices = dict(zip(locations, arrays))
+    grid = np.arange(max(locations), min(locations) - thickness, -thickness)
+    for i, location in enumerate(grid):
+        if location in slices:
+            continue
+        prev = grid[i - 1]
+        nxt = next(g for g in grid[i + 1:] if g in locations)
+        x1, x2 = abs(location - prev), abs(nxt - location)
+        r1, r2 = x1 / (x1 + x2), x2 / (x1 + x2)
+        slices[location] = (r1 * slices[prev] + r2 * slices[nxt]).astype('uint16')
+    return [slices[location] for location in grid]
+
+
+@pytest.mark.parametrize('storage', ['image', 'array'])
+def test_batched_interpolation_matches_slice_by_slice(adc_series, storage):
+    folder, arrays = adc_series([(24, 20)] * len(LOCATIONS), locations=LOCATIONS)
+    volume = VolumeCollection(path=folder, storage=storage).volumes['adc']
+    volume.correct_slice_contiguity(print_results=False)
+
+    expected = interpolate_slice_by_slice(LOCATIONS, arrays)
+    assert [s.slice_location for s in volume.slices] == [40, 35, 30, 25, 20, 15, 10, 5, 0]
+    for s, array in zip(volume.slices, expected):
+        assert s.array.dtype == np.uint16
+        np.testing.assert_array_equal(s.array, array)
+        assert s.origin == volume.slices[0].origin
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+import numpy as np
+import SimpleITK as sitk
+import pytest
+from volume_correction import crop_to_fov, resample_to_fov, match_volumes_to_fov
+
+SPACING, ORIGIN = (1.0, 1.2, 5.0), (-10.0, -20.0, 0.0)
+
+
+def image_volume(seed=0, shape=(6, 20, 16)):
+    array = np.random.default_rng(seed).integers(0, 1000, shape).astype(np.uint16)
+    img_vol = sitk.GetImageFromArray(array)
+    img_vol.SetSpacing(SPACING)
+    img_vol.SetOrigin(ORIGIN)
+    return img_vol
+
+
+@pytest.mark.parametrize('start, size', [((0, 0, 0), (16, 20, 6)),  # whole volume
+                                         ((3, 2, 1), (8, 10, 4)),  # inside
+                                         ((-2, 5, -1), (12, 20, 4))])  # partly outside, filled with zeros
+def test_crop_matches_resample_on_grid(start, size):
+    img_vol = image_volume()
+    origin = img_vol.TransformIndexToPhysicalPoint(start)
+    cropped = crop_to_fov(img_vol, origin, size)
+    resampled = resample_to_fov(img_vol, origin, size)
+    for get in ('GetOrigin', 'GetSpacing', 'GetDirection', 'GetSize'):
+        assert getattr(cropped, get)() == getattr(resampled, get)()
+
+    # crop keeps exact intensities, zero padded like the resample
+    padded = np.pad(sitk.GetArrayFromImage(img_vol), 8)
+    window = tuple(slice(8 + b, 8 + b + n) for b, n in zip(start[::-1], size[::-1]))
+    np.testing.assert_array_equal(sitk.GetArrayFromImage(cropped), padded[window])
+    # linear resampling of on-grid points gives the same, apart from rounding down in the cast back to uint16
+    difference = sitk.GetArrayFromImage(cropped).astype(int) - sitk.GetArrayFromImage(resampled)
+    assert difference.min() >= 0 and difference.max() <= 1
+
+
+def test_crop_needs_origin_on_grid():
+    img_vol = image_volume()
+    origin = np.add(img_vol.TransformIndexToPhysicalPoint((1, 1, 1)), (0.5, 0, 0))
+    assert crop_to_fov(img_vol, tuple(origin), (4, 4, 2)) is None
+
+
+def test_match_volumes_to_fov_reports_method(capsys):
+    on_grid = SimpleNamespace(name='on grid', image_volume=image_volume(0))
+    off_grid = SimpleNamespace(name='off grid', image_volume=image_volume(1))
+    off_grid.image_volume.SetOrigin(np.add(ORIGIN, (0.3, 0, 0)).tolist())
+    other_off_grid = SimpleNamespace(name='other off grid', image_volume=image_volume(2))
+    other_off_grid.image_volume.SetOrigin(np.add(ORIGIN, (0, 0.4, 0)).tolist())
+    volumes = [on_grid, off_grid, other_off_grid]
+    expected = [crop_to_fov(on_grid.image_volume, (-8.0, -17.6, 5.0), (10, 12, 4))] + \
+        [resample_to_fov(v.image_volume, (-8.0, -17.6, 5.0), (10, 12, 4)) for v in volumes[1:]]
+
+    match_volumes_to_fov(volumes, (-8.0, -17.6, 5.0), (10, 14.4, 20), workers=2)
+    methods = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Method:')]
+    assert methods == ['Method: crop', 'Method: linear resampling', 'Method: linear resampling']
+    for volume, img_vol in zip(volumes, expected):
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(volume.image_volume), sitk.GetArrayFromImage(img_vol))
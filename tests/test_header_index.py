@@ -0,0 +1,54 @@
+import os
+from header_index import HeaderIndex
+from volume_correction import VolumeCollection
+
+
+def load(folder, header_index=True):
+    return VolumeCollection(path=folder, header_index=header_index, registration_cache=False)
+
+
+def test_reload_reuses_index(adc_series, capsys):
+    folder, arrays = adc_series([(32, 24)] * 4)
+    first = load(folder)
+    assert ' 0 file headers found in index' in capsys.readouterr().out
+    second = load(folder)
+    assert ' 4 file headers found in index' in capsys.readouterr().out
+
+    assert first.volumes.keys() == second.volumes.keys() == {'adc'}
+    for a, b in zip(first.volumes['adc'].slices, second.volumes['adc'].slices):
+        assert (a.dcm_path, a.slice_location, a.header_origin) == (b.dcm_path, b.slice_location, b.header_origin)
+
+
+def test_reload_prunes_removed_files(adc_series):
+    folder, arrays = adc_series([(32, 24)] * 4)
+    load(folder)
+    removed = os.path.join(folder, '003.dcm')
+    os.remove(removed)
+    assert len(load(folder).volumes['adc']) == 3
+    with HeaderIndex(folder) as index:
+        assert removed not in index.rows and len(index.rows) == 3
+
+
+def test_unwritable_index_loads_without_it(adc_series, monkeypatch, capsys):
+    folder, arrays = adc_series([(32, 24)] * 2)
+    monkeypatch.setattr(HeaderIndex, 'index_path', staticmethod(lambda path: os.path.join(path, 'missing', 'x')))
+    assert len(load(folder).volumes['adc']) == 2
+    assert 'Header index not available' in capsys.readouterr().out
+
+
+def test_index_off_by_default(adc_series):
+    folder, arrays = adc_series([(32, 24)] * 2)
+    VolumeCollection(path=folder, registration_cache=False)
+    assert not os.path.exists(HeaderIndex.index_path(folder))
+
+
+def test_changed_files_are_read_again(adc_series, capsys):
+    folder, arrays = adc_series([(32, 24)] * 4)
+    load(folder)
+    changed = os.path.join(folder, '001.dcm')
+    stat = os.stat(changed)
+    os.utime(changed, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    capsys.readouterr()
+    assert len(load(folder).volumes['adc']) == 4
+    out = capsys.readouterr().out
+    assert ' 3 file headers found in index' in out and ' Scanning 1 files' in out
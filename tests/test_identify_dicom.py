@@ -0,0 +1,47 @@
+from pydicom.dataset import Dataset
+from identify_dicom import DICOMName
+
+
+def trace_header(sequence_name, series_uid='1.2.3.4'):
+    dcm_header = Dataset()
+    dcm_header.SeriesInstanceUID = series_uid
+    dcm_header.SequenceName = sequence_name
+    dcm_header.ImageType = ['ORIGINAL', 'PRIMARY', 'DIFFUSION', 'TRACEW']
+    dcm_header.ManufacturerModelName = 'Avanto'
+    return dcm_header
+
+
+def test_memoised_per_series_and_b_value():
+    DICOMName.clear_cache()
+    assert DICOMName(trace_header('*ep_b50t')).series == 'b50'
+    assert DICOMName(trace_header('*ep_b800t')).series == 'b800'  # same series, different b-value
+    assert DICOMName(trace_header('*ep_b50t')).series == 'b50'
+    assert len(DICOMName.cache) == 2
+
+
+def test_not_memoised_without_series_uid():
+    DICOMName.clear_cache()
+    dcm_header = trace_header('*ep_b50t')
+    del dcm_header.SeriesInstanceUID
+    assert DICOMName(dcm_header).series == 'b50'
+    assert not DICOMName.cache
+
+
+def test_echoes_of_one_series_named_separately():
+    DICOMName.clear_cache()
+    names = []
+    for echo_time in (2.38, 4.76, 2.38):
+        dcm_header = trace_header('*fl3d2')
+        dcm_header.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'DIXON']
+        dcm_header.ScanOptions = ''
+        dcm_header.EchoTime = echo_time
+        names.append(DICOMName(dcm_header).series)
+    assert names == ['out', 'in', 'out']
+
+
+def test_adc_and_trace_of_one_series_named_separately():
+    DICOMName.clear_cache()
+    adc = trace_header('*ep_b1000t')
+    adc.ImageType = ['DERIVED', 'PRIMARY', 'DIFFUSION', 'ADC']
+    assert DICOMName(trace_header('*ep_b1000t')).series == 'b1000'
+    assert DICOMName(adc).series == 'adc'
@@ -0,0 +1,39 @@
+import numpy as np
+from volume_correction import VolumeCollection
+
+
+def test_lazy_slice_arrays_survive_eviction(adc_series):
+    folder, arrays = adc_series([(64, 64)] * 20)
+    # room for only a couple of slice images, so stacking every slice evicts the earlier ones
+    collection = VolumeCollection(path=folder, header_index=False, registration_cache=False, lazy=True,
+                                  cache_size=0.02)
+    volume = collection.volumes['adc']
+    assert np.array_equal(np.stack([s.array for s in volume.slices]), np.stack(arrays[::-1]))
+    assert len(collection.pixel_cache) <= 2
+
+
+def test_pinned_defers_eviction(adc_series):
+    folder, _ = adc_series([(64, 64)] * 10)
+    collection = VolumeCollection(path=folder, header_index=False, registration_cache=False, lazy=True,
+                                  cache_size=0.02)
+    volume = collection.volumes['adc']
+    with volume.pinned():
+        [s.array for s in volume.slices]
+        assert len(collection.pixel_cache) == len(volume)
+    assert len(collection.pixel_cache) <= 2
+
+
+def test_registration_images_count_against_budget(adc_series):
+    folder, _ = adc_series([(64, 64)] * 10)
+    # room for two slice images, or one with its float32 registration image
+    collection = VolumeCollection(path=folder, header_index=False, registration_cache=False, lazy=True,
+                                  cache_size=0.02)
+    volume = collection.volumes['adc']
+    for s in volume.slices:
+        s.registration_image()
+    assert len(collection.pixel_cache) == 1
+    assert len(volume.registration_images) == 1
+    assert collection.pixel_cache.nbytes == 64 * 64 * (2 + 4)
+
+    volume.slices[-1].discard_registration_images()
+    assert collection.pixel_cache.nbytes == 64 * 64 * 2
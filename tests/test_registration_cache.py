@@ -0,0 +1,24 @@
+import os
+from registration_cache import RegistrationCache
+from volume_correction import VolumeCollection
+
+
+def test_cache_off_by_default(adc_series):
+    folder, arrays = adc_series([(32, 24)] * 2)
+    assert VolumeCollection(path=folder).registration_cache is None
+    assert not os.path.exists(RegistrationCache.cache_path(folder))
+
+
+def test_unwritable_cache_registers_without_it(adc_series, monkeypatch, capsys):
+    folder, arrays = adc_series([(32, 24)] * 2)
+    monkeypatch.setattr(RegistrationCache, 'cache_path', staticmethod(lambda path: os.path.join(path, 'missing', 'x')))
+    assert VolumeCollection(path=folder, registration_cache=True).registration_cache is None
+    assert 'Registration cache not available' in capsys.readouterr().out
+
+
+def test_cache_round_trip(tmp_path):
+    with RegistrationCache(str(tmp_path / 'input')) as cache:
+        cache.update('key', (1.5, -2.0), [-0.5, -0.75], -0.75, 2, 'min_step')
+    with RegistrationCache(str(tmp_path / 'input')) as cache:
+        assert cache.lookup('key') == ((1.5, -2.0), [-0.5, -0.75], -0.75, 2, 'min_step')
+        assert cache.lookup('other') is None
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from registration_cache import RegistrationCache
+from registration_tools import SliceTranslation, level_iteration_caps, phase_correlation
+from volume_correction import VolumeCollection
+from conftest import write_adc_series
+
+SHIFTS = [(-3, 2), (7, 5), (0.3, -0.4), (2.5, -1.25), (-6.7, 3.2), (0, 0), (10.2, -8.6)]
+
+
+def shifted_crops(shifts, shape=(96, 128), sigma=2, seed=0):
+    """Fixed and moving crops (slices, rows, cols) of smooth random textures, the moving crop showing the texture
+    shifted by (x, y) pixels. Shifted by the Fourier shift theorem on a larger image, so crops don't wrap around"""
+    rng = np.random.default_rng(seed)
+    size = 256
+    frequencies = np.fft.fftfreq(size)
+    fixed, moving = [], []
+    for x, y in shifts:
+        spectrum = np.fft.fft2(rng.normal(size=(size, size)))
+        spectrum *= np.exp(-2 * (np.pi * sigma) ** 2 * (frequencies[:, None] ** 2 + frequencies[None] ** 2))
+        phase = np.exp(-2j * np.pi * (frequencies[None] * x + frequencies[:, None] * y))
+        image, shifted = (np.fft.ifft2(s).real * 1000 + 2000 for s in (spectrum, spectrum * phase))
+        crop = (slice(80, 80 + shape[0]), slice(64, 64 + shape[1]))
+        fixed.append(image[crop])
+        moving.append(shifted[crop])
+    return np.stack(fixed), np.stack(moving)
+
+
+def test_phase_correlation_recovers_known_shifts():
+    fixed, moving = shifted_crops(SHIFTS)
+    np.testing.assert_allclose(phase_correlation(fixed, moving), SHIFTS, atol=0.02)
+
+
+def test_phase_correlation_batches():
+    fixed, moving = shifted_crops(SHIFTS * 3, seed=1)
+    np.testing.assert_array_equal(phase_correlation(fixed, moving, batch_size=4),
+                                  phase_correlation(fixed, moving, batch_size=32))
+
+
+class ImageSlice:
+    """Stand-in for volume_correction.Slice with just what SliceTranslation reads"""
+
+    def __init__(self, array, slice_location=0.0):
+        self.image = sitk.GetImageFromArray(array.astype(np.float32))
+        self.array = sitk.GetArrayFromImage(self.image)
+        self.spacing, self.origin = self.image.GetSpacing(), self.image.GetOrigin()
+        self.slice_location = slice_location
+
+    def registration_image(self, log=False):
+        return self.image
+
+
+def test_keep_better_restores_and_caches_the_kept_result(tmp_path):
+    fixed, moving = shifted_crops([(2, -1)], shape=(48, 64))
+    registration = SliceTranslation(ImageSlice(moving[0]))
+    registration.fixed = ImageSlice(fixed[0])
+    registration.set_result((0.5, 0.25), [-3.0, -4.0], metric_value=-4.0, duration=1.5, iterations=2,
+                            stop_condition='min_step')
+    registration.cached, registration.cache_key = True, 'previous'
+    previous = registration.result_state()
+
+    cache = RegistrationCache(str(tmp_path / 'input'))
+    registration.calculate_transformation(keep_better=True, cache=cache)
+    state = registration.result_state()
+    assert state.pop('transformation').GetParameters() == previous.pop('transformation').GetParameters()
+    assert state == previous
+
+    key = registration.registration_key(log=False, seed=None, initial=None)
+    assert cache.lookup(key) == ((0.5, 0.25), [-3.0, -4.0], -4.0, 2, 'min_step')
+    cache.close()
+
+
+def test_level_iteration_caps():
+    assert level_iteration_caps(None, (4, 2, 1)) is None
+    assert level_iteration_caps(20, (4, 2, 1)) == (20, 20, 20)
+    assert level_iteration_caps(20) == (20,)
+    assert level_iteration_caps([30, 20, 10], (4, 2, 1)) == (30, 20, 10)
+    with pytest.raises(ValueError, match='2 values for 3 registration levels'):
+        level_iteration_caps([30, 20], (4, 2, 1))
+
+
+def test_int_level_iterations_caps_every_level():
+    fixed, moving = shifted_crops([(2, -1)], shape=(48, 64))
+    registration = SliceTranslation(ImageSlice(moving[0]))
+    registration.fixed = ImageSlice(fixed[0])
+    registration.calculate_transformation(seed=0, shrink_factors=(2, 1), smoothing_sigmas=(1, 0),
+                                          level_iterations=3)
+    assert registration.iterations <= 6
+    with pytest.raises(ValueError):
+        registration.calculate_transformation(shrink_factors=(2, 1), level_iterations=[3])
+
+
+def translated_volumes(tmp_path, storage, translations):
+    """Moving and reference ADC volumes, with the given (x, y) translation set as each moving slice's result"""
+    moving_folder, reference_folder = str(tmp_path / 'moving'), str(tmp_path / 'reference')
+    write_adc_series(moving_folder, [(24, 20)] * len(translations), seed=0)
+    write_adc_series(reference_folder, [(24, 20)] * len(translations), seed=1)
+    moving = VolumeCollection(path=moving_folder, storage=storage).volumes['adc']
+    reference = VolumeCollection(path=reference_folder).volumes['adc']
+    moving.set_registration_as_translation()
+    moving.registration.reference_volume = reference
+    for s, translation in zip(moving.slices, translations):
+        s.registration.set_result(translation, [])
+    return moving
+
+
+@pytest.mark.parametrize('storage', ['image', 'array'])
+def test_transform_volume_matches_slice_transforms(tmp_path, storage):
+    translations = [(0, 0), (1.5, -2.25), (-3.7, 0.4), (30, 0), (0.01, -40), (-0.5, 0.5)]
+    batched = translated_volumes(tmp_path / 'batched', storage, translations)
+    assert batched.registration.transform_volume()
+    per_slice = translated_volumes(tmp_path / 'per_slice', storage, translations)
+    for s in per_slice.slices:
+        s.registration.transform()
+
+    for a, b in zip(batched.slices, per_slice.slices):
+        np.testing.assert_array_equal(a.array, b.array)
+        assert a.array.dtype == b.array.dtype == np.uint16
+        assert (a.origin, a.spacing) == (b.origin, b.spacing)
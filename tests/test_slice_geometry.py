@@ -0,0 +1,43 @@
+import numpy as np
+from slice_geometry import SliceGeometry
+from volume_correction import VolumeCollection
+
+LOCATIONS = [30, 25, 20, 20, 15, 12, 7, 2, -5]  # descending, one duplicate, off grid between 15 and -5
+
+
+def test_slice_geometry():
+    geometry = SliceGeometry(LOCATIONS, 5)
+    np.testing.assert_array_equal(geometry.intervals, [5, 5, 0, 5, 3, 5, 5, 7])
+    np.testing.assert_array_equal(geometry.duplicates, [2])
+    np.testing.assert_array_equal(geometry.run_starts, [0, 3, 5])
+    np.testing.assert_array_equal(geometry.run_ends, [2, 4, 7])
+    assert geometry.largest_contiguous_block() == (0, 2)
+    np.testing.assert_array_equal(geometry.on_grid(30), [1, 1, 1, 1, 1, 0, 0, 0, 1])
+    np.testing.assert_array_equal(geometry.has_location([20.004, 10, -5]), [True, False, True])
+    np.testing.assert_array_equal(geometry.missing_grid_locations(30, 20), [10, 5, 0])
+
+
+def test_slice_geometry_tolerance():
+    assert SliceGeometry([10, 5.003, 0], 5).largest_contiguous_block() == (0, 2)
+    assert SliceGeometry([10, 5.003, 0], 5, tolerance=0.001).run_starts.size == 0
+
+
+def test_correct_slice_contiguity(adc_series):
+    folder, _ = adc_series([(16, 16)] * len(LOCATIONS), locations=LOCATIONS[::-1])
+    volume = VolumeCollection(path=folder).volumes['adc']
+    volume.correct_slice_contiguity(print_results=False)
+    assert [s.slice_location for s in volume.slices] == [30, 25, 20, 15, 10, 5, 0, -5]
+    assert {s.slice_interval for s in volume.slices} == {5, None}
+
+
+def test_station_index_reads_no_pixels(adc_series):
+    folder, _ = adc_series([(32, 24)] * 6)
+    collection = VolumeCollection(path=folder, lazy=True)
+    volume = collection.volumes['adc']
+    index = volume.station_index()
+    assert all(s._image is None for s in volume.slices)
+
+    [s.image for s in volume.slices]
+    loaded = volume.station_index()
+    np.testing.assert_array_equal(index.stations, loaded.stations)
+    np.testing.assert_array_equal(index.table, loaded.table)
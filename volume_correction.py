@@ -3,28 +3,53 @@ import pydicom
 from pydicom.errors import InvalidDicomError
 import SimpleITK as sitk
 from tqdm import tqdm
-from itertools import compress, cycle, islice
+from itertools import compress
 from more_itertools import run_length
 import numpy as np
 import matplotlib.pyplot as plt
 import time
 from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
 from termcolor import colored
 from matplotlib.collections import PatchCollection
 from matplotlib.patches import Rectangle
-from registration_tools import VolumeSliceTranslation, SliceTranslation
-from identify_dicom import DICOMName
+from registration_tools import VolumeSliceTranslation, SliceTranslation, register_concurrently, array_to_image
 from dicom_writer import write_dcm_series
+from dicom_reader import scan_dcm_headers, read_dcm_series, group_dcm_series, HEADER_TAGS
+from header_index import HeaderIndex
+from registration_cache import RegistrationCache
+from pixel_cache import PixelCache, image_nbytes
+from slice_array import SliceArray
+from slice_geometry import SliceGeometry, StationIndex
 import coronal_tools
 
 
 class VolumeCollection:
-    def __init__(self, *, path):
+    def __init__(self, *, path, workers=None, executor='thread', header_index=False, fast_headers=True, lazy=False,
+                 cache_size=None, storage='image', memmap=False, registration_cache=False):
+        if storage not in ('image', 'array'):
+            raise ValueError(f"Unknown storage '{storage}', use 'image' or 'array'")
+        if lazy and storage == 'array':
+            raise ValueError("Lazy loading is only available with 'image' storage")
+
         self.path = path
         self.sup_folder = path.split('/')[0]  # todo: really need to improve how paths set globally with the mr_id
         self.volumes = {}
-        self.load_dicom_files()
+        self.lazy = lazy  # if lazy, slice pixel data is only read from file when first accessed
+        self.pixel_cache = PixelCache(cache_size * 2**20) if lazy and cache_size else None  # cache_size in MB
+        self.storage = storage  # 'image': each slice owns a 2D image, 'array': volume owns one SliceArray
+        self.memmap = memmap  # keep SliceArray pixel data in a memory-mapped temporary file
+        # if registration_cache is set, registration results of this session are kept on disk next to the session
+        # folder, keyed by image content and parameters
+        self.registration_cache = RegistrationCache.open(path) if registration_cache else None
+        self.load_dicom_files(workers=workers, executor=executor, header_index=header_index, fast_headers=fast_headers)
+
+        if not lazy:
+            print(' Reading pixel data')
+            for volume in self.volumes.values():
+                volume.read_slice_images()
 
         for volume_name, volume in self.volumes.items():
             volume.calculate_slice_intervals()
@@ -41,26 +66,44 @@ class VolumeCollection:
             for filename in fileList:
                 yield os.path.join(dirName, filename)
 
-    def load_dicom_files(self):
+    def load_dicom_files(self, workers=None, executor='thread', header_index=False, fast_headers=True):
         """Read each DCM file header, identify dicom scan type, instantiate volume if it doesn't already
-        exist. Instantiate and add slice to volume"""
+        exist. Instantiate and add slice to volume. Headers are read by a pool of workers ('thread' or
+        'process' executor) if workers is set. If header_index is set, headers of files that haven't changed
+        since the last load are taken from the session's HeaderIndex (written next to the session folder, skipped if
+        that isn't writable) rather than re-read. If fast_headers is set,
+        only the tags needed for classification are parsed (full headers are read once per volume)"""
         # tqdm implementation taken from: https://github.com/tqdm/tqdm/wiki/How-to-make-a-great-Progress-Bar
-        file_counter = 0
         dcm_file_counter = 0
-        for _ in self.walk_directory(self.path):
-            file_counter += 1
-
-        print(' Scanning {} files'.format(file_counter))
-        time.sleep(.3)  # for some unknown reason the tqdm print starts before the previous print statement
-        with tqdm(total=file_counter) as pbar:
-            for path in self.walk_directory(self.path):
-                try:
-                    dcm_header = pydicom.dcmread(path, stop_before_pixels=True)
-                    name = DICOMName(dcm_header)
-
-                    if name:
-                        volume_name = name.series
+        paths = sorted(self.walk_directory(self.path))  # sorted so that volumes are built in a fixed order
+
+        index = HeaderIndex.open(self.path) if header_index else None
+        try:
+            indexed = {}
+            if index:
+                index.prune(paths)
+                indexed = {path: record for path in paths if (record := index.lookup(path)) is not None}
+                print(' {} file headers found in index'.format(len(indexed)))
+
+            unindexed = [path for path in paths if path not in indexed]
+            scanned = scan_dcm_headers(unindexed, workers=workers, executor=executor,
+                                       tags=HEADER_TAGS if fast_headers else None)
+
+            print(' Scanning {} files'.format(len(unindexed)))
+            time.sleep(.3)  # for some unknown reason the tqdm print starts before the previous print statement
+            with tqdm(total=len(paths)) as pbar:
+                for path in paths:
+                    if path in indexed:
+                        dcm_header, volume_name = indexed[path]
+                    else:
+                        _, dcm_header, volume_name = next(scanned)
+                        if index:
+                            index.update(path, dcm_header, volume_name)
+
+                    if volume_name:
                         if volume_name not in self.volumes.keys():
+                            if fast_headers or path in indexed:  # volume needs the full header for writing DICOMs
+                                dcm_header = pydicom.dcmread(path, stop_before_pixels=True)
                             self.volumes.update({volume_name: Volume(self, volume_name, dcm_header)})
 
                         if dcm_header.StudyInstanceUID == self.volumes[volume_name].dcm_header.StudyInstanceUID:
@@ -69,16 +112,17 @@ class VolumeCollection:
                         else:
                             raise ValueError("Multiple Study UIDs found for some volume type!")
 
-                except InvalidDicomError:
-                    pass
-                pbar.set_postfix(file=path[-10:], refresh=True)
-                pbar.update()
+                    pbar.set_postfix(file=path[-10:], refresh=True)
+                    pbar.update()
+        finally:
+            if index:
+                index.close()
 
         print(f'{dcm_file_counter} DICOM files loaded')
 
-    def correct_slice_contiguity(self):
+    def correct_slice_contiguity(self, tolerance=None):
         for volume_name, volume in self.volumes.items():
-            volume.correct_slice_contiguity()
+            volume.correct_slice_contiguity(tolerance=tolerance)
 
     def display_slices(self, slice_idx, grid=True, text=True):
         """Create 2x2 subplot array and populate axis with slice image determined by slice_idx """
@@ -99,12 +143,24 @@ class VolumeCollection:
                 volume.set_registration_as_translation()
                 volume.registration.reference_volume = reference
 
-    def register_slices(self, reference_name='adc', smooth=False):
-        """Used too run registration in one-shot using pre-set values"""
+    def register_slices(self, reference_name='adc', smooth=False, concurrent=False, **kwargs):
+        """Used too run registration in one-shot using pre-set values, kwargs passed to VolumeSliceTranslation
+        (eg. workers, seed, multi-resolution schedule or smoothing parameters). If concurrent, the slices of all
+        series are registered together across one pool of workers, plotting once all series are done"""
         reference = self.volumes[reference_name]
-        for volume in self.volumes.values():
-            if volume is not reference:
-                volume.registration(reference=reference, smooth=smooth)
+        registrations = [volume.registration for volume in self.volumes.values() if volume is not reference]
+        if concurrent:
+            register_concurrently(registrations, reference, smooth=smooth, **kwargs)
+        else:
+            for registration in registrations:
+                registration(reference=reference, smooth=smooth, **kwargs)
+        for s in reference.slices:  # prepared reference slices were shared by all series, now release
+            s.discard_registration_images()
+
+    def registration_summary(self):
+        """Print and return the registration telemetry summary of each registered volume"""
+        return [volume.registration.summary() for volume in self.volumes.values()
+                if volume.registration is not None and volume.registration.reference_volume is not None]
 
     def compile_volumes(self):
         for volume in self.volumes.values():
@@ -142,7 +198,9 @@ class VolumeCollection:
         #     if not ax.collections:
         #         ax.axis('off')
 
-    def resample_volumes_to_match(self, print_results=True):
+    def resample_volumes_to_match(self, workers=None, print_results=True):
+        """Crop or resample every volume to the smallest common field of view. Volumes whose voxel grid the new origin
+        lies on are cropped, the rest are resampled, concurrently in workers threads if given"""
         img_vols = []
         for volume in self.volumes.values():
             if volume.image_volume is None:
@@ -154,40 +212,7 @@ class VolumeCollection:
         origin = tuple(np.max([img_vol.GetOrigin()[i] for img_vol in img_vols]) for i in range(3))
         extent = tuple(np.min([img_vol.GetSize()[i] * img_vol.GetSpacing()[i] for img_vol in img_vols]) for i in range(3))
 
-        for volume in self.volumes.values():
-            img_vol = volume.image_volume
-            spacing = img_vol.GetSpacing()
-            new_size = tuple(int(round(extent / spacing, 0)) for extent, spacing in zip(extent, spacing))
-
-            resample = sitk.ResampleImageFilter()
-            resample.SetOutputSpacing(spacing)
-            resample.SetSize(new_size)
-            resample.SetOutputDirection(img_vol.GetDirection())
-            resample.SetOutputOrigin(origin)
-            resample.SetTransform(sitk.Transform())
-            resample.SetDefaultPixelValue(0)
-            resample.SetInterpolator(sitk.sitkLinear)
-
-            # quick function for rounding tuples:
-            round_tuple = lambda t, n=2: tuple(round(e, n) for e in t)
-
-            # record these values before execution for comparison
-            old_origin = round_tuple(img_vol.GetOrigin())
-            old_extent = round_tuple(tuple(sp * si for sp, si in zip(img_vol.GetSpacing(), img_vol.GetSize())))
-            old_size = round_tuple(img_vol.GetSize())
-
-            volume.image_volume = resample.Execute(img_vol)
-
-            new_origin = round_tuple(volume.image_volume.GetOrigin())  # todo: set as vol.image_vol to really check
-            new_extent = round_tuple(tuple(sp * si for sp, si in zip(volume.image_volume.GetSpacing(),
-                                                                     volume.image_volume.GetSize())))
-            new_size = round_tuple(volume.image_volume.GetSize())
-
-            if print_results:
-                print(f'------- Resampling {volume.name} -------')
-                print('Origin:', old_origin, '---->', new_origin)
-                print('Extent:', old_extent, '---->', new_extent)
-                print('Size:', old_size, '---->', new_size, '\n')
+        match_volumes_to_fov(list(self.volumes.values()), origin, extent, workers=workers, print_results=print_results)
 
     def resample_slices_to_common_origin(self):
         for volume in self.volumes.values():
@@ -197,11 +222,16 @@ class VolumeCollection:
         for volume in self.volumes.values():
             volume.reformat_to_axial()
 
-    def stitch_coronal_slices(self):
+    def stitch_coronal_slices(self, workers=None):
         for volume in self.volumes.values():
-            volume.stitch_coronal_slices()
-
-    def register_coronal_stations(self, *, reference_name, num_stations=3):
+            volume.stitch_coronal_slices(workers=workers)
+
+    def register_coronal_stations(self, *, reference_name, num_stations=3, workers=None, shrink_factors=None,
+                                  smoothing_sigmas=None, print_results=True):
+        """Register the stations of every volume to those of the reference volume. With workers, the stations of each
+        volume are registered concurrently in that many threads. Multi-resolution if shrink_factors (and
+        smoothing_sigmas in mm) are given per level, coarsest first, eg. shrink_factors=(4, 2, 1),
+        smoothing_sigmas=(2, 1, 0)"""
         for volume in self.volumes.values():
             if volume.image_volume is None:
                 volume.compile_volume_from_slices()
@@ -209,10 +239,18 @@ class VolumeCollection:
         reference = self.volumes[reference_name]
         for volume in self.volumes.values():
             if volume is not reference:
-                print(f'Registering {num_stations} stations of {volume.name} volume to {reference.name} volume')
+                if print_results:
+                    print(f'Registering {num_stations} stations of {volume.name} volume to {reference.name} volume')
                 volume.image_volume = coronal_tools.register_stations_in_volume(volume.image_volume,
                                                                                 reference.image_volume,
-                                                                                num_stations=num_stations)
+                                                                                num_stations=num_stations,
+                                                                                cache=self.registration_cache,
+                                                                                workers=workers,
+                                                                                shrink_factors=shrink_factors,
+                                                                                smoothing_sigmas=smoothing_sigmas,
+                                                                                print_results=print_results)
+        if self.registration_cache is not None:
+            self.registration_cache.commit()
 
     def info(self):
         for volume in self.volumes.values():
@@ -230,7 +268,10 @@ class Volume:
         self.orientation = None
         self.check_direction()
         self.slice_thickness = round(float(dcm_header.SliceThickness), 2)
+        self.tolerance = 0.005  # mm, slice locations and intervals closer than this are treated as equal
         self.image_volume = None
+        self.slice_array = None
+        self.registration_images = {}  # slice: {log: float32 image}, prepared for registration
         self.registration = None
         # todo: going to need to think hard about how coronal data will be managed
 
@@ -247,39 +288,88 @@ class Volume:
     def add_slice(self, dcm_path, dcm_header):
         """Add new Slice object to Volume slices list"""
         # slice_location = float(dcm_header.SliceLocation)  # Doesn't work for some old coronal data...
+        position = [float(p) for p in dcm_header.ImagePositionPatient]
         if self.orientation == 'tra':
-            slice_location = float(dcm_header.ImagePositionPatient[2])
+            slice_location = position[2]
+            header_origin = (position[0], position[1])
         elif self.orientation == 'cor':
-            slice_location = float(dcm_header.ImagePositionPatient[1])
+            slice_location = position[1]
+            header_origin = (position[0], position[2])  # x, z location of coronal images stored as x, y
+
+        # pixel data read later, by series
+        self.slices.append(Slice(self, dcm_path, slice_location, lazy=True, header_origin=header_origin))
 
-        self.slices.append(Slice(self, dcm_path, slice_location))
+    def read_slice_images(self):
+        """Read images of all slices that haven't been loaded yet in one batched series read per matrix size"""
+        slices = [s for s in self.slices if s.dcm_path and s._image is None and s.array_index is None]
+        if not slices:
+            return
+
+        paths = [s.dcm_path for s in slices]
+        try:
+            series = [(slices, read_dcm_series(paths))]
+        except RuntimeError:
+            # slices with different matrix sizes can't be read as one series, so read a series per size
+            series = [([slices[i] for i in group], read_dcm_series([paths[i] for i in group]))
+                      for group in group_dcm_series(paths)]
+
+        if not self.dcm_reader:
+            self.dcm_reader = series[0][1][3]
+
+        # x, z location of coronal images stored as x, y
+        in_plane = [0, 2] if self.orientation == 'cor' else [0, 1]
+
+        # a SliceArray holds slices of one size, so volumes of mixed sizes keep an image per slice
+        if self.vol_collection.storage == 'array' and self.slice_array is None and len(series) == 1:
+            array, positions, spacing, _ = series[0][1]
+            self.slice_array = SliceArray(array, positions[:, in_plane], spacing, memmap=self.vol_collection.memmap)
+            for i, s in enumerate(slices):
+                s.array_index = i
+            return
+
+        pixel_cache = self.vol_collection.pixel_cache
+        for group, (array, positions, spacing, _) in series:
+            for s, pixels, origin in zip(group, array, positions[:, in_plane]):
+                image = sitk.GetImageFromArray(pixels)
+                image.SetSpacing(spacing)
+                image.SetOrigin(tuple(origin))
+                s._image = image
+                if pixel_cache is not None:
+                    pixel_cache.add(s, image)
+
+    def pinned(self):
+        """Context in which no slice images of the collection are evicted, for building a batch of slice arrays"""
+        pixel_cache = self.vol_collection.pixel_cache
+        return pixel_cache.pinned() if pixel_cache is not None else nullcontext()
 
     def sort_slice_order(self):
         """Sort slices in descending order of slice location - superior to inferior for head first scan"""
         self.slices.sort(key=lambda s: s.slice_location, reverse=True)
 
     def calculate_slice_intervals(self):
-        """Calculate intervals between ordered slices"""
+        """Calculate intervals between ordered slices, returning the SliceGeometry of the volume"""
         self.sort_slice_order()
-        for i in range(len(self)-1):
-            interval = self.slices[i+1].slice_location - self.slices[i].slice_location
-            self.slices[i].slice_interval = round(abs(interval), 2)
+        geometry = SliceGeometry([s.slice_location for s in self.slices], self.slice_thickness, self.tolerance)
+        for s, interval in zip(self.slices, geometry.intervals):
+            s.slice_interval = round(float(interval), 2)
         self.slices[-1].slice_interval = None
+        return geometry
 
     def info(self, display_order=False):
         print('-' * 5, self.name, 'volume', '-' * 5)
         print(f'{len(self)} slices')
         print(f'Orientation: {self.orientation}')
-        x = round(self.slices[0].image.GetOrigin()[0], 2)
-        y = round(self.slices[0].image.GetOrigin()[1], 2)
+        origin, size, spacing = self.slices[0].geometry()
+        x = round(origin[0], 2)
+        y = round(origin[1], 2)
         z = round(self.slices[-1].slice_location, 2)  # z-origin used to be defined as slices[0].slice_location
         print(f'Origin (x,y,z) = ({x}, {y}, {z})')
-        x = self.slices[0].image.GetSize()[0]
-        y = self.slices[0].image.GetSize()[1]
+        x = size[0]
+        y = size[1]
         z = len(self)
         print(f'Size (x,y,z) = ({x}, {y}, {z})')
-        x = round(self.slices[0].image.GetSpacing()[0], 2)
-        y = round(self.slices[0].image.GetSpacing()[1], 2)
+        x = round(spacing[0], 2)
+        y = round(spacing[1], 2)
         z = round(self.slice_thickness, 2)
         print(f'Spacing (x,y,z) = ({x}, {y}, {z})')
         print('Slice Information:')
@@ -307,17 +397,16 @@ class Volume:
         # https://stackoverflow.com/questions/8312829/how-to-remove-item-from-a-python-list-in-a-loop
         # todo: need to edit code so that it can handle when there are no duplicates
 
-        self.calculate_slice_intervals()
+        geometry = self.calculate_slice_intervals()
 
         selectors = [True for s in self.slices]
-        for i in range(len(self.slices) - 1):
-            if self.slices[i].slice_interval == 0:
-                total = sitk.GetArrayFromImage(self.slices[i].image).sum()
-                total_next = sitk.GetArrayFromImage(self.slices[i + 1].image).sum()
-                if total < total_next:
-                    selectors[i] = False
-                else:
-                    selectors[i + 1] = False
+        for i in geometry.duplicates:
+            total = self.slices[i].array.sum(dtype=np.uint64)
+            total_next = self.slices[i + 1].array.sum(dtype=np.uint64)
+            if total < total_next:
+                selectors[i] = False
+            else:
+                selectors[i + 1] = False
 
         num_before = len(self)
         self.slices = list(compress(self.slices, selectors))
@@ -330,28 +419,13 @@ class Volume:
 
     def find_contiguous_block(self, print_results=True):
         """Find and label the largest consecutive group of contiguous slices and return indices """
-        self.calculate_slice_intervals()
-        # create list of slice intervals:
-        intervals = [s.slice_interval for s in self.slices]
-        # Run length encoding to group consecutive equal slice intervals in list of tuples: [(interval, count), ...]:
-        groups = list(run_length.encode(intervals))
-        # Keep groups where interval == slice thickness:
-        # todo: should I be using isclose() here rather than == due to float?
-        contiguous_groups = list(filter(lambda x: x[0] == self.slice_thickness, groups))
-        # Find group tuple with largest count:
-        largest_contiguous_group = max(contiguous_groups, key=lambda x: x[1])
-        # Find index of that tuple in groups
-        index_in_groups = groups.index(largest_contiguous_group)
-        # Calculate index positions of start and end of that group in intervals list:
-        start_idx = sum([x[1] for x in groups][:index_in_groups])
-        end_idx = sum([x[1] for x in groups][:index_in_groups + 1])
-
-        # for i in range(start_idx, end_idx + 1):
-        #     self.slices[i].contiguous = True
+        geometry = self.calculate_slice_intervals()
+        # Largest run of consecutive intervals equal (within tolerance) to slice thickness:
+        start_idx, end_idx = geometry.largest_contiguous_block()
 
         # Label contiguous slices, including those away from the main block:
-        for s in self.slices:
-            if round(s.slice_location - self.slices[start_idx].slice_location, 2) % self.slice_thickness == 0:
+        for s, on_grid in zip(self.slices, geometry.on_grid(self.slices[start_idx].slice_location)):
+            if on_grid:
                 s.contiguous = True
 
         if print_results:
@@ -365,7 +439,7 @@ class Volume:
                                                                                         d=round(end_location, 2)))
         return start_idx, end_idx
 
-    def correct_slice_contiguity(self, print_results=True):
+    def correct_slice_contiguity(self, print_results=True, tolerance=None):
         # todo: could rename this to resample to common grid?
         """1. Remove duplicated slices
            2. Find and label largest contiguous group to minimise resampling
@@ -374,6 +448,8 @@ class Volume:
            4. Calculate pixel values for new slices
            5. Remove old non-contiguous slices """
 
+        if tolerance is not None:
+            self.tolerance = tolerance
         if print_results:
             print('-'*5, self.name, 'volume', '-'*5)
         self.remove_duplicated_slices(print_results)
@@ -382,21 +458,12 @@ class Volume:
         start_location = self.slices[start_idx].slice_location  # start location of largest contiguous block
         end_location = self.slices[end_idx].slice_location  # end location of largest contiguous block
 
-        first_slice_location = self.slices[0].slice_location  # location of first slice in volume
-        last_slice_location = self.slices[-1].slice_location  # location of last slice in volume
-
-        # instantiate new contiguous slices
-        num_new_slices = 0
-        slice_locs = [round(s.slice_location, 2) for s in self.slices]
-        for slice_loc in np.arange(start_location + self.slice_thickness, first_slice_location, self.slice_thickness):
-            if round(slice_loc, 2) not in slice_locs:
-                self.slices.append(Slice(self, dcm_path=None, slice_location=slice_loc, contiguous=True))
-                num_new_slices += 1
-
-        for slice_loc in np.arange(end_location - self.slice_thickness, last_slice_location, -self.slice_thickness):
-            if round(slice_loc, 2) not in slice_locs:
-                self.slices.append(Slice(self, dcm_path=None, slice_location=slice_loc, contiguous=True))
-                num_new_slices += 1
+        # instantiate new contiguous slices, on grid locations out to either end of the volume without a slice
+        geometry = SliceGeometry([s.slice_location for s in self.slices], self.slice_thickness, self.tolerance)
+        new_slice_locs = geometry.missing_grid_locations(start_location, end_location)
+        for slice_loc in new_slice_locs:
+            self.slices.append(Slice(self, dcm_path=None, slice_location=slice_loc, contiguous=True))
+        num_new_slices = len(new_slice_locs)
 
         self.sort_slice_order()
         self.calculate_empty_slices()
@@ -410,43 +477,60 @@ class Volume:
         self.calculate_slice_intervals()
 
     def calculate_empty_slices(self):
-        for i, s in enumerate(self.slices):
-            if s.image is None and s.contiguous is True:
-                s_prev = self.get_next_complete_slice(i, reverse=True)
-                s_next = self.get_next_complete_slice(i)
-                sl_prev, sl, sl_next = s_prev.slice_location, s.slice_location, s_next.slice_location
-                pa_prev = sitk.GetArrayFromImage(s_prev.image)
-                pa_next = sitk.GetArrayFromImage(s_next.image)
-                x1, x2 = abs(sl - sl_prev), abs(sl_next - sl)
-                r1, r2 = (x1 / (x1 + x2)), (x2 / (x1 + x2))
-                pa = r1 * pa_prev + r2 * pa_next
-                pa = pa.astype('uint16')
-                s.image = sitk.GetImageFromArray(pa)
-                s.image.CopyInformation(s_prev.image)
-                # origin_prev = s.image.GetOrigin()
-                # origin = origin_prev[0], origin_prev[1], s.slice_location
-                # s.image.SetOrigin(origin)
-
-    def get_next_complete_slice(self, slice_idx, reverse=False):
-        while True:
-            slice_idx = slice_idx - 1 if reverse else slice_idx + 1
-            if self.slices[slice_idx].image is not None:
-                break
-        return self.slices[slice_idx]
+        """Linearly interpolate new (empty) contiguous slices from the nearest complete slices either side. Empty
+        slices at the same position within each gap are interpolated together, in one vectorised step"""
+        empty = np.array([s.dcm_path is None and s._image is None and s.array_index is None and s.contiguous is True
+                          for s in self.slices])
+        if not empty.any():
+            return
+
+        idx = np.arange(len(self.slices))
+        locations = np.array([s.slice_location for s in self.slices])
+        # index of nearest complete slice before and after each slice:
+        prev_complete = np.maximum.accumulate(np.where(empty, -1, idx))
+        next_complete = np.minimum.accumulate(np.where(empty, len(idx), idx)[::-1])[::-1]
+        position_in_gap = idx - prev_complete - 1
+
+        # each position in gap interpolated from the previous one, once that has been filled:
+        for position in range(position_in_gap[empty].max() + 1):
+            batch = idx[empty & (position_in_gap == position)]
+            idx_prev, idx_next = batch - 1, next_complete[batch]
+            x1 = np.abs(locations[batch] - locations[idx_prev])
+            x2 = np.abs(locations[idx_next] - locations[batch])
+            r1, r2 = (x1 / (x1 + x2))[:, None, None], (x2 / (x1 + x2))[:, None, None]
+            with self.pinned():
+                pa_prev = np.stack([self.slices[i].array for i in idx_prev])
+                pa_next = np.stack([self.slices[i].array for i in idx_next])
+            pa = (r1 * pa_prev + r2 * pa_next).astype('uint16')
+
+            for i, i_prev, pixels in zip(batch, idx_prev, pa):
+                image = sitk.GetImageFromArray(pixels)
+                image.SetSpacing(self.slices[i_prev].spacing)
+                image.SetOrigin(self.slices[i_prev].origin)
+                self.slices[i].image = image
 
     def compile_volume_from_slices(self):
         if len(set([s.slice_interval for s in self.slices if s.slice_interval is not None])) > 1:
             raise ValueError(f'{self.name} volume is not contiguous!')
 
-        if len(Counter(s.image.GetOrigin() for s in self.slices)) > 1:
+        if len(Counter(s.origin for s in self.slices)) > 1:
             print(f'Resampling {self.name} volume to common origin!')
             self.resample_slices_to_common_origin()
 
-        images = [s.image for s in self.slices]
-        images.reverse()  # otherwise nifti volumes come out upside down in ITK-SNAP todo: need to look into this
+        slices = self.slices[::-1]  # otherwise nifti volumes come out upside down in ITK-SNAP todo: need to look into this
         origin = self.slices[-1].slice_location
         spacing = self.slice_thickness
-        self.image_volume = sitk.JoinSeries(images, origin, spacing)
+        if self.slice_array is not None:
+            # single array to image conversion, no copies when slices are still in array order
+            if all(s.array_index is not None for s in slices):
+                array = self.slice_array.stack([s.array_index for s in slices])
+            else:
+                array = np.stack([s.array for s in slices])
+            self.image_volume = sitk.GetImageFromArray(array)
+            self.image_volume.SetSpacing((*slices[0].spacing, spacing))
+            self.image_volume.SetOrigin((*slices[0].origin, origin))
+        else:
+            self.image_volume = sitk.JoinSeries([s.image for s in slices], origin, spacing)
 
         if self.orientation == 'cor':  # bit of a hack fix for coronal data
             self.image_volume.SetDirection((1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, -1.0, 0.0))
@@ -529,7 +613,7 @@ class Volume:
 
     def resample_slices_to_common_origin(self):
         """For volumes that have multiple origins, resample to most common origin for each slice """
-        origin_counts = Counter(s.image.GetOrigin() for s in self.slices)
+        origin_counts = Counter(s.origin for s in self.slices)
         most_common_origin = origin_counts.most_common(1)[0][0]
 
         ref_image = next((s.image for s in self.slices if s.image.GetOrigin() == most_common_origin), None)
@@ -552,18 +636,42 @@ class Volume:
         print(f'------- Reformating {self.name} -------')
         self.image_volume = coronal_tools.reformat_to_axial(self.image_volume)
 
-    def stitch_coronal_slices(self):
+    def station_index(self):
+        """StationIndex of the slices by slice location and station (z origin of the slice image). Origins are taken
+        from the DICOM headers of slices that haven't been read, so this doesn't load pixel data"""
+        return StationIndex([s.geometry()[0][1] for s in self.slices], [s.slice_location for s in self.slices],
+                            self.tolerance)
+
+    def stitch_coronal_slices(self, workers=None, print_results=True):
+        """Stitch the station slices at each slice location, found from the station index so that slices can be in
+        any order. Locations missing a station's slice are left out, to be filled by correct_slice_contiguity.
+        Locations are stitched concurrently by a pool of workers (threads) if workers is set"""
         if self.orientation == 'tra':
             raise ValueError("Volume is in transaxial orientation!")
 
-        num_stations = len(set(s.image.GetOrigin()[1] for s in self.slices))
-        c = cycle(self.slices)
+        index = self.station_index()
+        if print_results and (index.duplicates or not index.complete.all()):
+            print(f'{self.name}: {len(index.stations)} stations, {index.duplicates} duplicated slices ignored, '
+                  f'{(~index.complete).sum()} slice locations missing a station left out:',
+                  [round(location, 2) for location in index.locations[~index.complete].tolist()])
+
+        groups = [[self.slices[i] for i in row] for row in index.table[index.complete]]
+        slice_locations = [group[0].slice_location for group in groups]
+
+        stitched = self.stitch_station_arrays(groups, workers)
+        if stitched is not None:
+            array, origin, spacing = stitched
+            stitched_images = [array_to_image(a, spacing, origin) for a in array]
+        else:
+            stitch = lambda group: coronal_tools.stitch([s.image for s in group], group[0].slice_location)
+            if workers:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    stitched_images = list(pool.map(stitch, groups))
+            else:
+                stitched_images = list(map(stitch, groups))
+
         stitched_slices = []
-        for i in range(int(len(self) / num_stations)):
-            unstitched_slices = list(islice(c, num_stations))
-            unstitched_images = [s.image for s in unstitched_slices]
-            slice_location = unstitched_slices[0].slice_location
-            stitched_image = coronal_tools.stitch(unstitched_images, slice_location)
+        for slice_location, stitched_image in zip(slice_locations, stitched_images):
             stitched_slice = Slice(parent_volume=self, slice_location=slice_location)
             stitched_slice.image = stitched_image
             stitched_slices.append(stitched_slice)
@@ -572,17 +680,132 @@ class Volume:
         self.sort_slice_order()
         self.calculate_slice_intervals()
 
+    def stitch_station_arrays(self, groups, workers=None):
+        """Stitch every group of station slices (one slice per station, in the same station order) in one pass with
+        coronal_tools.stitch_stations. Returns None if the slices aren't all uint16 slices of the same size with the
+        same origin in each station"""
+        if not groups:
+            return None
+        with self.pinned():
+            station_origins = [s.origin for s in groups[0]]
+            arrays = [[s.array for s in group] for group in groups]
+            if any([s.origin for s in group] != station_origins for group in groups) \
+                    or len({a.shape for group in arrays for a in group}) != 1 \
+                    or any(a.dtype != np.uint16 for group in arrays for a in group):
+                return None
+            stations = np.stack(arrays, axis=1)
+        return coronal_tools.stitch_stations(stations, [s.image for s in groups[0]], groups[0][0].slice_location,
+                                             workers=workers)
+
+
+class ImageBuffer:
+    """Pixel buffer of a SimpleITK image for np.asarray. Unlike sitk.GetArrayViewFromImage, arrays made from it keep
+    a reference to the image (as their base), so the buffer isn't freed while they are in use"""
+
+    def __init__(self, image):
+        self.image = image
+        self.__array_interface__ = sitk.GetArrayViewFromImage(image).__array_interface__
+
 
 class Slice:
-    def __init__(self, parent_volume=None, dcm_path=None, slice_location=None, contiguous=False):
+    def __init__(self, parent_volume=None, dcm_path=None, slice_location=None, contiguous=False, lazy=False,
+                 header_origin=None):
         self.volume = parent_volume
         self.dcm_path = dcm_path
         self.slice_location = slice_location
+        self.header_origin = header_origin  # in-plane (x, y) origin of the image, from the DICOM header
         self.slice_interval = None
-        self.image = None
+        self._image = None
+        self.array_index = None  # index into volume's SliceArray for array-backed slices
+        self.lazy = lazy  # lazy slices read their image on first access and can have it evicted from memory
         self.contiguous = contiguous
         self.registration = None
-        self.load_sitk_image()
+        if not lazy:
+            self.load_sitk_image()
+
+    @property
+    def image(self):
+        if self.array_index is not None:
+            return self.volume.slice_array.get_image(self.array_index)
+        if self._image is None and self.lazy:
+            self.load_sitk_image()
+        elif self.pixel_cache is not None:
+            self.pixel_cache.touch(self)
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self.discard_registration_images()
+        if self.array_index is not None:
+            if self.volume.slice_array.set_image(self.array_index, image):
+                return
+            self.array_index = None  # image doesn't fit the volume's array anymore, slice keeps its own
+        # image no longer matches the DICOM file, so it must stay in memory
+        self.lazy = False
+        if self.pixel_cache is not None:
+            self.pixel_cache.discard(self)
+        self._image = image
+
+    def discard_registration_images(self):
+        if self.volume is not None:
+            images = self.volume.registration_images.pop(self, None)
+            if images and self.pixel_cache is not None:
+                self.pixel_cache.charge(self, -sum(image_nbytes(image) for image in images.values()))
+
+    def registration_image(self, log=False):
+        """Float32 image (log image if specified) for registration. Cached by the volume until the slice image
+        changes, so a reference slice is only prepared once when several series are registered to it"""
+        if self.volume is None:
+            return SliceTranslation.prepare_image(self.image, log)
+        images = self.volume.registration_images.setdefault(self, {})
+        if log not in images:
+            image = images[log] = SliceTranslation.get_log_image(self.registration_image()) if log \
+                else SliceTranslation.prepare_image(self.image)
+            if self.pixel_cache is not None:
+                self.pixel_cache.charge(self, image_nbytes(image))
+            return image
+        return images[log]
+
+    @property
+    def array(self):
+        """NumPy view of slice pixel data, without copying. The view keeps the image it was taken from alive, so it
+        stays valid if the slice's image is evicted or replaced"""
+        if self.array_index is not None:
+            return self.volume.slice_array.array[self.array_index]
+        return np.asarray(ImageBuffer(self.image))
+
+    @property
+    def origin(self):
+        if self.array_index is not None:
+            return self.volume.slice_array.get_origin(self.array_index)
+        return self.image.GetOrigin()
+
+    @property
+    def spacing(self):
+        if self.array_index is not None:
+            return self.volume.slice_array.spacing
+        return self.image.GetSpacing()
+
+    @property
+    def pixel_cache(self):
+        return self.volume.vol_collection.pixel_cache if self.volume else None
+
+    def geometry(self):
+        """In-plane (origin, size, spacing) of the slice image. Taken from the DICOM headers when the image hasn't
+        been read, so that this doesn't decode pixel data"""
+        if self.array_index is not None:
+            return self.origin, self.volume.slice_array.array.shape[:0:-1], self.spacing
+        if self._image is not None or self.header_origin is None:
+            return self.origin, self.image.GetSize(), self.spacing
+        dcm_header = self.volume.dcm_header
+        pixel_spacing = [float(sp) for sp in dcm_header.PixelSpacing]  # (row, column) spacing
+        return self.header_origin, (int(dcm_header.Columns), int(dcm_header.Rows)), tuple(pixel_spacing[::-1])
+
+    def evict(self):
+        """Release image, to be re-read from the DICOM file when next accessed"""
+        if self.lazy and self.array_index is None:
+            self._image = None
+            self.discard_registration_images()
 
     def load_sitk_image(self):
         if self.dcm_path:  # if there is a DICOM file to load
@@ -608,7 +831,9 @@ class Slice:
                 min_max_filter.Execute(img)
                 img = sitk.InvertIntensity(img, maximum=min_max_filter.GetMaximum())
 
-            self.image = img
+            self._image = img
+            if self.lazy and self.pixel_cache is not None:
+                self.pixel_cache.add(self, img)
 
             if self.volume and not self.volume.dcm_reader:
                 self.volume.dcm_reader = reader  # keep one reader for volume to make writing DICOMs easy
@@ -640,13 +865,14 @@ class Slice:
         return t  # todo: not sure this return actually does anything
 
     def get_rectangle_repr(self):
-        slice_width = self.image.GetWidth() * self.image.GetSpacing()[0]
+        # slice width from the volume header so that displaying slice locations doesn't need pixel data
+        slice_width = self.volume.dcm_header.Columns * float(self.volume.dcm_header.PixelSpacing[1])
         xy = (0, self.slice_location - self.volume.slice_thickness)  # bottom left of rectangle
         return Rectangle(xy, width=slice_width, height=self.volume.slice_thickness)
         # todo: can make them different colors based on series number? r.set_color
 
 
-def match_fovs_between_collections(*collections, print_results=True):
+def match_fovs_between_collections(*collections, workers=None, print_results=True):
     img_vols = []
     for col in collections:
         for volume in col.volumes.values():
@@ -660,41 +886,79 @@ def match_fovs_between_collections(*collections, print_results=True):
     origin = tuple(np.max([img_vol.GetOrigin()[i] for img_vol in img_vols]) for i in range(3))
     extent = tuple(np.min([img_vol.GetSize()[i] * img_vol.GetSpacing()[i] for img_vol in img_vols]) for i in range(3))
 
-    for col in collections:
-        for volume in col.volumes.values():
-            img_vol = volume.image_volume
-            spacing = img_vol.GetSpacing()
-            new_size = tuple(int(round(extent / spacing, 0)) for extent, spacing in zip(extent, spacing))
-
-            resample = sitk.ResampleImageFilter()
-            resample.SetOutputSpacing(spacing)
-            resample.SetSize(new_size)
-            resample.SetOutputDirection(img_vol.GetDirection())
-            resample.SetOutputOrigin(origin)
-            resample.SetTransform(sitk.Transform())
-            resample.SetDefaultPixelValue(0)
-            resample.SetInterpolator(sitk.sitkLinear)
-
-            # quick function for rounding tuples:
-            round_tuple = lambda t, n=2: tuple(round(e, n) for e in t)
-
-            # record these values before execution for comparison
-            old_origin = round_tuple(img_vol.GetOrigin())
-            old_extent = round_tuple(tuple(sp * si for sp, si in zip(img_vol.GetSpacing(), img_vol.GetSize())))
-            old_size = round_tuple(img_vol.GetSize())
-
-            volume.image_volume = resample.Execute(img_vol)
-
-            new_origin = round_tuple(volume.image_volume.GetOrigin())  # todo: set as vol.image_vol to really check
-            new_extent = round_tuple(tuple(sp * si for sp, si in zip(volume.image_volume.GetSpacing(),
-                                                                     volume.image_volume.GetSize())))
-            new_size = round_tuple(volume.image_volume.GetSize())
-
-            if print_results:
-                print(f'------- Resampling {volume.name} -------')
-                print('Origin:', old_origin, '---->', new_origin)
-                print('Extent:', old_extent, '---->', new_extent)
-                print('Size:', old_size, '---->', new_size, '\n')
+    match_volumes_to_fov([volume for col in collections for volume in col.volumes.values()], origin, extent,
+                         workers=workers, print_results=print_results)
+
+
+def match_volumes_to_fov(volumes, origin, extent, workers=None, print_results=True):
+    """Set the image volume of each Volume to the field of view starting at origin with extent (mm), keeping its
+    spacing and direction. Volumes with origin on their voxel grid are cropped by array slicing, keeping exact
+    intensities. The rest are linearly resampled, concurrently in workers threads if given (ITK releases the GIL)"""
+    origin = tuple(float(o) for o in origin)
+    img_vols = [volume.image_volume for volume in volumes]
+    sizes = [tuple(int(round(e / sp, 0)) for e, sp in zip(extent, img_vol.GetSpacing())) for img_vol in img_vols]
+
+    new_img_vols = [crop_to_fov(img_vol, origin, size) for img_vol, size in zip(img_vols, sizes)]
+    methods = ['crop' if new_img_vol is not None else 'linear resampling' for new_img_vol in new_img_vols]
+    to_resample = [i for i, new_img_vol in enumerate(new_img_vols) if new_img_vol is None]
+    resample = lambda i: resample_to_fov(img_vols[i], origin, sizes[i])
+    if workers and len(to_resample) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            resampled = list(executor.map(resample, to_resample))
+    else:
+        resampled = list(map(resample, to_resample))
+    for i, new_img_vol in zip(to_resample, resampled):
+        new_img_vols[i] = new_img_vol
+
+    # quick function for rounding tuples:
+    round_tuple = lambda t, n=2: tuple(round(e, n) for e in t)
+    extent_of = lambda img_vol: round_tuple(tuple(sp * si for sp, si in zip(img_vol.GetSpacing(), img_vol.GetSize())))
+
+    for volume, img_vol, new_img_vol, method in zip(volumes, img_vols, new_img_vols, methods):
+        volume.image_volume = new_img_vol
+        if print_results:
+            print(f'------- Resampling {volume.name} -------')
+            print('Method:', method)
+            print('Origin:', round_tuple(img_vol.GetOrigin()), '---->', round_tuple(new_img_vol.GetOrigin()))
+            print('Extent:', extent_of(img_vol), '---->', extent_of(new_img_vol))
+            print('Size:', img_vol.GetSize(), '---->', new_img_vol.GetSize(), '\n')
+
+
+def crop_to_fov(img_vol, origin, size, tolerance=1e-6):
+    """Crop img_vol to size voxels starting at origin by array slicing, with zeros outside img_vol as when resampling.
+    Returns None unless origin lies (within tolerance voxels) on the voxel grid of img_vol, when resampling would
+    interpolate"""
+    offset = np.array(img_vol.TransformPhysicalPointToContinuousIndex(origin))
+    start = np.round(offset).astype(int)
+    if not np.allclose(offset, start, rtol=0, atol=tolerance):
+        return None
+
+    # NumPy array axes are in reverse order (z, y, x) of index axes
+    array = sitk.GetArrayViewFromImage(img_vol)
+    cropped = np.zeros(size[::-1], dtype=array.dtype)
+    start, stop = start[::-1], start[::-1] + size[::-1]
+    src = tuple(slice(max(b, 0), min(e, n)) for b, e, n in zip(start, stop, array.shape))
+    dst = tuple(slice(s.start - b, s.stop - b) for s, b in zip(src, start))
+    if all(s.start < s.stop for s in src):
+        cropped[dst] = array[src]
+
+    new_img_vol = sitk.GetImageFromArray(cropped)
+    new_img_vol.SetSpacing(img_vol.GetSpacing())
+    new_img_vol.SetOrigin(origin)
+    new_img_vol.SetDirection(img_vol.GetDirection())
+    return new_img_vol
+
+
+def resample_to_fov(img_vol, origin, size):
+    resample = sitk.ResampleImageFilter()
+    resample.SetOutputSpacing(img_vol.GetSpacing())
+    resample.SetSize(size)
+    resample.SetOutputDirection(img_vol.GetDirection())
+    resample.SetOutputOrigin(origin)
+    resample.SetTransform(sitk.Transform())
+    resample.SetDefaultPixelValue(0)
+    resample.SetInterpolator(sitk.sitkLinear)
+    return resample.Execute(img_vol)
 
 
 def force_orientation_to_orthogonal(path, cor=False):